@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+
+"""Benchmark the stages of convertbibliography.py on made-up data.
+
+    python3 cb_benchmark.py --entries 1000 10000 100000 --output bench.json
+
+Each size is run in a fresh process, so its peak RSS is its own. The
+results are JSON: for every size, the best time of fix_keys, parsing, each
+customization, the DOI lookups, and writing, with the throughput of each.
+CrossRef is replaced by a stand-in which makes up DOIs, so nothing goes
+over the network; --crossref-latency adds a delay to each of its answers.
+"""
+
+import argparse
+import collections
+import contextlib
+import copy
+import datetime
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import time
+
+import bibtexparser
+from bibtexparser.bibdatabase import BibDatabase
+from bibtexparser.bparser import BibTexParser
+from bibtexparser.bwriter import BibTexWriter
+
+import cb_customs
+import convertbibliography
+
+titles = [
+    'the logic of "quotes" and things',
+    "a theory of `justice'",
+    'on what there is: an essay',
+    'truth & meaning — again',
+    '{Protected Title}',
+    'knowledge, 50% of the_time',
+    'two dogmas – of empiricism',
+    "naming and ``necessity''",
+    'Über die {Grundlagen} der Arithmetik',
+    'la {\\\'e}thique et le d{\\\'e}sir',
+    'mind, world, and the 2nd problem of induction'
+]
+
+authors = [
+    'hodgson, thomas',
+    'QUINE, W. V. O. and kripke, saul',
+    'lewis, david and anderson, alan',
+    'G{\\"o}del, Kurt',
+    'Frege, Gottlob and Müller, Jürgen and Søren Kierkegaard',
+    'de Beauvoir, Simone'
+]
+
+journals = [
+    'Journal of Philosophy',
+    'Mind',
+    'Philosophical Review',
+    'Synthese & Co',
+    'Zeitschrift für philosophische Forschung'
+]
+
+publishers = [
+    'Oxford and Cambridge',
+    'Oxford University Press',
+    'Éditions du Seuil'
+]
+
+pages = ['100--15', 'pp. 12-9', '100–105', '1-1000', '213', 'e1002']
+
+languages = ['english', 'German', 'french']
+
+# The share of each entry type in a corpus
+entry_types = [('article', 6), ('book', 2), ('incollection', 2)]
+
+
+def synthetic_entry(rng, i):
+    """ random.Random, int -> str
+    Make an entry which exercises the customizations.
+    """
+    entrytype = rng.choice(
+        [name for name, weight in entry_types for _ in range(weight)]
+    )
+    fields = [
+        'title = {{{}}}'.format(rng.choice(titles)),
+        'author = {{{}}}'.format(rng.choice(authors)),
+        'year = {{{}}}'.format(rng.randint(1900, 2020))
+    ]
+    if entrytype == 'article':
+        fields.append('journal = {{{}}}'.format(rng.choice(journals)))
+        fields.append('pages = {{{}}}'.format(rng.choice(pages)))
+        fields.append('volume = {{{}}}'.format(rng.randint(1, 120)))
+        fields.append('abstract = {{{}}}'.format(' '.join(titles)))
+        if rng.random() < 0.5:
+            fields.append('doi = {{10.1000/{}}}'.format(i))
+        if rng.random() < 0.3:
+            fields.append('issn = {0026-4423}')
+            fields.append('epub = {yes}')
+    elif entrytype == 'incollection':
+        fields.append('booktitle = {{{}}}'.format(rng.choice(titles)))
+        fields.append('editor = {{{}}}'.format(rng.choice(authors)))
+        fields.append('pages = {{{}}}'.format(rng.choice(pages)))
+        fields.append('publisher = {{{}}}'.format(rng.choice(publishers)))
+    else:
+        fields.append('publisher = {{{}}}'.format(rng.choice(publishers)))
+        fields.append('edition = {second}')
+        fields.append('address = {Oxford}')
+    if rng.random() < 0.3:
+        language = rng.choice(languages)
+        fields.append('language = {{{}}}'.format(language))
+        fields.append('langid = {{{}}}'.format(language.lower()))
+    if rng.random() < 0.2:
+        fields.append('keywords = {philosophy, logic}')
+        fields.append('file = {{:/papers/{}.pdf:PDF}}'.format(i))
+    # Some entries come without a citekey, for fix_keys to deal with
+    key = '' if rng.random() < 0.05 else 'key{}'.format(i)
+    return '@{}{{{},\n    {}\n}}\n'.format(
+        entrytype, key, ',\n    '.join(fields)
+    )
+
+
+def synthetic_bib(n, seed=0):
+    """ int -> str
+    Make a bibliography of n entries which exercises the customizations.
+    """
+    rng = random.Random(seed)
+    return '\n'.join(synthetic_entry(rng, i) for i in range(n))
+
+
+class StandInResponse(object):
+    """What CrossRefStandIn gives back: a made-up DOI for the query"""
+
+    status_code = 200
+
+    def __init__(self, query):
+        self.doi = '10.5555/' + hashlib.sha1(
+            query.encode('utf-8')
+        ).hexdigest()[:12]
+
+    def json(self):
+        return {'message': {'items': [{'DOI': self.doi}]}}
+
+
+class CrossRefStandIn(object):
+    """Used in place of the session cb_customs.lookup_doi talks to CrossRef
+    with, so DOIs can be benchmarked offline.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def get(self, url, params=None):
+        if self.latency:
+            time.sleep(self.latency)
+        return StandInResponse(params['query'])
+
+    def close(self):
+        pass
+
+
+def peak_rss():
+    """ -> int
+    Return the peak resident set size of this process in bytes.
+    """
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def timed(function, repeat):
+    """ (-> a), int -> (float, a)
+    Call function repeat times, and return the best time and the last result.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def stage(seconds, n, megabytes=None):
+    """ float, int, float -> dict
+    Describe how long a stage took.
+    """
+    result = {
+        'seconds': seconds,
+        'us_per_record': seconds / n * 1e6,
+        'records_per_second': n / seconds if seconds else None
+    }
+    if megabytes is not None:
+        result['mb_per_second'] = megabytes / seconds if seconds else None
+    return result
+
+
+def run(n, repeat=3, crossref_latency=0.0, doi_workers=4):
+    """ int, int, float, int -> dict
+    Time each stage of a conversion of a synthetic bibliography of n entries.
+    """
+    content = synthetic_bib(n)
+    megabytes = len(content.encode('utf-8')) / 1e6
+    stages = collections.OrderedDict()
+    # The customizations print warnings about the records
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        seconds, fixed = timed(
+            lambda: '\n'.join(convertbibliography.fix_keys(content.split('\n'))),
+            repeat
+        )
+        stages['fix_keys'] = stage(seconds, n, megabytes)
+
+        def parse():
+            return BibTexParser(
+                fixed, customization=None, ignore_nonstandard_types=False
+            )
+        seconds, parsed = timed(parse, repeat)
+        stages['parse'] = stage(seconds, n, megabytes)
+
+        # Each step is timed on its own, keeping the best of the runs
+        steps = collections.OrderedDict()
+        records = None
+        for _ in range(repeat):
+            timings = collections.OrderedDict()
+            plan = convertbibliography.build_plan(
+                convertbibliography.chain, timings
+            )
+            records = copy.deepcopy(parsed.entries)
+            for i, record in enumerate(records):
+                for step in plan:
+                    record = step(record)
+                records[i] = record
+            for name, (seconds, calls) in timings.items():
+                steps[name] = min(steps.get(name, seconds), seconds)
+        stages['customizations'] = stage(sum(steps.values()), n)
+        stages['steps'] = collections.OrderedDict(
+            (name, stage(seconds, n)) for name, seconds in steps.items()
+        )
+
+        def find_dois():
+            convertbibliography.resolve_dois(
+                copy.deepcopy(records), workers=doi_workers
+            )
+        crossref_session = cb_customs.crossref_session
+        cb_customs.crossref_session = (
+            lambda workers=1: CrossRefStandIn(crossref_latency)
+        )
+        try:
+            seconds, _ = timed(find_dois, repeat)
+        finally:
+            cb_customs.crossref_session = crossref_session
+        stages['resolve_dois'] = stage(seconds, n)
+        stages['resolve_dois']['lookups'] = sum(
+            1 for record in records if cb_customs.doi_query(record)
+        )
+
+        database = BibDatabase()
+        database.entries = records
+        seconds, output = timed(lambda: BibTexWriter().write(database), repeat)
+        stages['write'] = stage(seconds, n)
+    return {
+        'entries': n,
+        'input_mb': megabytes,
+        'output_mb': len(output.encode('utf-8')) / 1e6,
+        'stages': stages,
+        'peak_rss_bytes': peak_rss()
+    }
+
+
+def run_isolated(n, repeat, crossref_latency, doi_workers):
+    """ int, int, float, int -> dict
+    Call run in a new process, so the peak RSS is for n entries alone.
+    """
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        return pool.apply(run, (n, repeat, crossref_latency, doi_workers))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--entries',
+        type=int,
+        nargs='+',
+        default=[1000, 10000, 100000],
+        help='Sizes of the bibliographies to time'
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help='Number of timings to take the best of'
+    )
+    parser.add_argument(
+        '--crossref-latency',
+        dest='crossreflatency',
+        type=float,
+        default=0.0,
+        help='Seconds the CrossRef stand-in waits before each answer'
+    )
+    parser.add_argument(
+        '--doi-workers',
+        dest='doiworkers',
+        type=int,
+        default=4,
+        help='Number of DOI lookups to have in flight at once'
+    )
+    parser.add_argument(
+        '--corpus',
+        metavar='DIR',
+        help='Also write the bibliographies to DIR as synthetic-N.bib'
+    )
+    parser.add_argument(
+        '--output',
+        help='Write the results to a file instead of stdout'
+    )
+    args = parser.parse_args()
+    if args.corpus:
+        os.makedirs(args.corpus, exist_ok=True)
+        for n in args.entries:
+            path = os.path.join(args.corpus, 'synthetic-{}.bib'.format(n))
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(synthetic_bib(n))
+    results = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'bibtexparser': bibtexparser.__version__,
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'crossref_latency': args.crossreflatency,
+        'runs': [
+            run_isolated(n, args.repeat, args.crossreflatency, args.doiworkers)
+            for n in args.entries
+        ]
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
@@ -1,7 +1,14 @@
+import functools
+import os
 import re
+import sqlite3
+import time
+
 import requests
 import titlecase
 
+import journal_index
+
 # I doubt if we need to go above ten
 words_to_numerals =\
     {
@@ -37,7 +44,36 @@ journals_needing_article =\
         'Philosophical Review'
     }
 
+# Compiled once here rather than on every field of every record
+patterns =\
+    {
+        'and': re.compile('and'),
+        'closing_quote': re.compile(r'(?<=\w)(\'{1,2}|"|”)(?:(?=\s)|(?=$))'),
+        'colon': re.compile(':'),
+        'digits': re.compile(r'\d+'),
+        'escaped_ampersand': re.compile(r'\\&'),
+        'hyphen': re.compile('-'),
+        'hyphens': re.compile('-+'),
+        'needs_protection': re.compile(r'(?<=\s)\S*[A-Z]+\S*|(?<=:\s)\S+'),
+        'non_word': re.compile(r'\W+'),
+        'opening_quote': re.compile(r'(?:(?<=\s)|(?<=^))((`|\'){1,2}|"|“)(?=\w)'),
+        'ordinal': re.compile(r'\d+(st|nd|rd|th)'),
+        'ordinal_suffix': re.compile('(st|nd|rd|th)'),
+        'outer_braces': re.compile('^{[^{}]*}$'),
+        'page_prefix': re.compile(r'[Pp]{1,2}\.?'),
+        'page_range': re.compile(r'^\d+-+\d+$'),
+        'reserved_characters': re.compile(r'(?<!\\)([&%_])'),
+        'resolver': re.compile('http://dx.doi.org/')
+    }
+
+# The most distinct strings each memoized transform remembers.
+# Titles, journals, and names recur a lot in a real bibliography.
+memo_size = 4096
 
+memoize = functools.lru_cache(maxsize=memo_size)
+
+
+@memoize
 def remove_outer_braces(s):
     """
     str -> str
@@ -52,11 +88,12 @@ def remove_outer_braces(s):
     >>> remove_outer_braces('{This} is a test')
     '{This} is a test'
     """
-    if re.search('^{[^{}]*}$', s):
+    if patterns['outer_braces'].search(s):
         s = s[1:-1]
     return s
 
 
+@memoize
 def full_range(s):
     """ str -> str
     Take a string representing a Biblatex page range (e.g. '100--45').
@@ -71,7 +108,7 @@ def full_range(s):
     >>> full_range('100-5')
     '100-105'
     """
-    parts = re.split('-+', s)
+    parts = patterns['hyphens'].split(s)
     if len(parts[1]) < len(parts[0]):
         difference = len(parts[0]) - len(parts[1])
         parts[1] = parts[0][:difference] + parts[1]
@@ -88,9 +125,10 @@ def remove_resolver(doi):
     >>> remove_resolver('10.1080/00455091.2013.871111')
     '10.1080/00455091.2013.871111'
     """
-    return re.sub('http://dx.doi.org/', '', doi)
+    return patterns['resolver'].sub('', doi)
 
 
+@memoize
 def title_name(name):
     """
     str -> str
@@ -102,11 +140,15 @@ def title_name(name):
     """
     name =\
         ' '.join(
-            [x.title() if not re.match('and', x) else x for x in name.split()]
+            [x.title() if not patterns['and'].match(x) else x for x in name.split()]
         )
     return name
 
 
+# titlecase.titlecase, remembering its answers
+title_case = memoize(titlecase.titlecase)
+
+
 def braces(s):
     """
     str -> str
@@ -124,6 +166,39 @@ def braces(s):
     return s
 
 
+def replace_dashes(s):
+    """
+    str -> str
+    Replace en and em dashes with hyphens.
+    >>> replace_dashes('1–2 — 3')
+    '1--2 --- 3'
+    """
+    return s.replace('–', '--').replace('—', '---')
+
+
+def escape_reserved(s):
+    r"""
+    str -> str
+    Escape the characters reserved by LaTeX ('&', '%', '_')
+    unless they are escaped already.
+    >>> print(escape_reserved('A & B, 50% and \_'))
+    A \& B, 50\% and \_
+    """
+    return patterns['reserved_characters'].sub(r'\\\1', s)
+
+
+def activate_quotes(s):
+    """
+    str -> str
+    Replace LaTeX quotes with unicode quotes.
+    >>> activate_quotes("``Quine'' and `Kripke'")
+    '‘Quine’ and ‘Kripke’'
+    """
+    # The regexes must be done like this to avoid balance problems
+    s = patterns['opening_quote'].sub('‘', s)
+    return patterns['closing_quote'].sub('’', s)
+
+
 def remove_series(record):
     """
     Remove Series fields.
@@ -147,11 +222,11 @@ def philpapers(record):
     :type record: dict
     :ret
     """
-    if re.search('-', record["ID"]):
+    if patterns['hyphen'].search(record["ID"]):
         # Split into a list at hyphens
-        segments = re.split('-', record["ID"])
+        segments = patterns['hyphen'].split(record["ID"])
         # Check whether we have an ID of the form 'FOOBAR-1'
-        if re.fullmatch('\d+', segments[-1]):
+        if patterns['digits'].fullmatch(segments[-1]):
             ppid = '{}-{}'.format(
                 segments[-2],
                 segments[-1]
@@ -170,14 +245,14 @@ def subtitles(record):
     :type record: dict
     :returns: dict -- the modified record.
     """
-    if "journaltitle" in record and re.search(':', record["journaltitle"]):
-        m = re.search(':', record["journaltitle"])
+    if "journaltitle" in record and patterns['colon'].search(record["journaltitle"]):
+        m = patterns['colon'].search(record["journaltitle"])
         title = record["journaltitle"][:m.start()].strip()
         subtitle = record["journaltitle"][m.end():].strip()
         record["journaltitle"] = title
         record["journalsubtitle"] = subtitle
-    if "title" in record and re.search(':', record["title"]):
-        m = re.search(':', record["title"])
+    if "title" in record and patterns['colon'].search(record["title"]):
+        m = patterns['colon'].search(record["title"])
         title = record["title"][:m.start()].strip()
         subtitle = record["title"][m.end():].strip()
         record["title"] = title
@@ -222,23 +297,8 @@ def active_quotes(record):
     :type record: dict
     :returns: dict -- the modified record.
     """
-    # The regexes must be done like this to avoid balance problems
-    # Match one or two '`', one or two ''', one '"', or one '“'
-    # preceded by space or the start of a string
     for field in record:
-        record[field] = re.sub(
-            '(?:(?<=\s)|(?<=^))((`|\'){1,2}|\"|“)(?=\w)',
-            '‘',
-            record[field]
-        )
-    # Match one or two ''', one '"', or one '”'
-    # followed by space or the end of a string
-    for field in record:
-        record[field] = re.sub(
-            '(?<=\w)(\'{1,2}|\"|”)(?:(?=\s)|(?=$))',
-            '’',
-            record[field]
-        )
+        record[field] = activate_quotes(record[field])
     return record
 
 
@@ -294,16 +354,16 @@ def empty_fields(record):
 def biblatex_page_ranges(record):
     if "pages" in record:
         # Get rid of p., pp. etc.
-        record["pages"] = re.sub('[Pp]{1,2}\\.?', '', record["pages"]).strip()
+        record["pages"] = patterns['page_prefix'].sub('', record["pages"]).strip()
         # If this is a range remove truncation and normalise it to two hyphens,
         # if not, complain
-        if re.search('^\d+-+\d+$', record["pages"]):
+        if patterns['page_range'].search(record["pages"]):
             record["pages"] = record["pages"] = full_range(
                 record["pages"]
             )
             # The function returns a single hyphen range,
             # so do the normalisation afterwards
-            record["pages"] = re.sub('-+', '--', record["pages"])
+            record["pages"] = patterns['hyphens'].sub('--', record["pages"])
 
         else:
             print(
@@ -323,9 +383,9 @@ def non_page_hyphens(record):
     :returns: dict -- the modified record.
     """
     if "volume" in record:
-        record["volume"] = re.sub('-+', '--', record["volume"])
+        record["volume"] = patterns['hyphens'].sub('--', record["volume"])
     if "number" in record:
-        record["number"] = re.sub('-+', '--', record["number"])
+        record["number"] = patterns['hyphens'].sub('--', record["number"])
     return record
 
 
@@ -338,8 +398,7 @@ def dashes(record):
     :returns: dict -- the modified record.
     """
     for field in record:
-        record[field] = re.sub('–', '--', record[field])
-        record[field] = re.sub('—', '---', record[field])
+        record[field] = replace_dashes(record[field])
     return record
 
 
@@ -371,66 +430,209 @@ def strip_doi(record):
     return record
 
 
-def get_doi(record):
+class DoiCache(object):
+    """
+    A persistent store of answers from the CrossRef API.
+
+    Answers are keyed by the query string `doi_query` builds.
+    A DOI of '' records that CrossRef had nothing for the query,
+    so that isn't asked again either.
+    Answers older than `ttl` seconds are ignored,
+    and the least recently used ones are dropped
+    when there are more than `max_entries`.
+
+    :param directory: where to keep the SQLite database.
+    :type directory: str
+    :param ttl: how long an answer is good for, in seconds.
+    :type ttl: float
+    :param max_entries: how many answers to keep.
+    :type max_entries: int
+    """
+
+    def __init__(self, directory, ttl=90 * 24 * 60 * 60, max_entries=100000):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, 'doi_cache.sqlite')
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS dois ('
+            'query TEXT PRIMARY KEY, doi TEXT NOT NULL, '
+            'fetched REAL NOT NULL, used REAL NOT NULL)'
+        )
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS dois_used ON dois (used)'
+        )
+
+    def get(self, query):
+        """
+        str -> (bool, str)
+        Look up a query.
+        Return whether a current answer was found, and the answer.
+        """
+        now = time.time()
+        row = self.connection.execute(
+            'SELECT doi FROM dois WHERE query = ? AND fetched > ?',
+            (query, now - self.ttl)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        self.connection.execute(
+            'UPDATE dois SET used = ? WHERE query = ?', (now, query)
+        )
+        return True, row[0]
+
+    def put(self, query, doi):
+        """
+        Store the answer to a query; '' means there is no DOI.
+        """
+        now = time.time()
+        self.connection.execute(
+            'INSERT OR REPLACE INTO dois (query, doi, fetched, used) '
+            'VALUES (?, ?, ?, ?)',
+            (query, doi, now, now)
+        )
+
+    def close(self):
+        """
+        Drop stale and surplus answers, then save everything to disk.
+        """
+        with self.connection:
+            self.connection.execute(
+                'DELETE FROM dois WHERE fetched <= ?',
+                (time.time() - self.ttl,)
+            )
+            self.connection.execute(
+                'DELETE FROM dois WHERE query IN ('
+                'SELECT query FROM dois ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            )
+        self.connection.close()
+
+
+def crossref_session(workers=1):
     """
-    Get DOIs for articles from the CrossRef API.
+    Make a keep-alive session for talking to the CrossRef API.
+
+    The connection pool is sized so that each worker can hold a connection.
+
+    :param workers: the number of threads that will share the session.
+    :type workers: int
+    :returns: requests.Session -- the session.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=max(workers, 1)
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def doi_query(record):
+    """
+    Build a CrossRef search term for an article without a DOI.
 
     :param record: the record.
     :type record: dict
-    :returns: dict -- the modified record.
+    :returns: str -- the query, or '' if the record doesn't need a DOI.
     """
+    # Build a search term for the API
+    query = ''
     if record["ENTRYTYPE"] == "article" and "doi" not in record:
-        # Build a search term for the API
-        query = ''
         # Build a query
         # The API doesn't like spaces or exotic characters
         if "title" in record:
-            query += re.sub('\W+', '+', record["title"])
+            query += patterns['non_word'].sub('+', record["title"])
             if "author" in record:
-                query += '+' + re.sub('\W+', '+', record["author"])
-        # I need to make sure a query has been built
-        if query:
-            payload = {
-                'query': query,
-                'rows': '1',
-                'sort': 'score',
-                'order': 'desc'
-            }
-            # We might not have an internet connection
-            # Catch the exception that will raise
-            r = requests.get(
-                'http://api.crossref.org/works',
-                params=payload
-            )
-            print(
-                'I got status code {} from the CrossRef API for record {}.'.format(
-                    r.status_code,
-                    record["ID"]
-                )
-            )
-            # Proceed if the status code was a good one
+                query += '+' + patterns['non_word'].sub('+', record["author"])
+    return query
+
+
+def lookup_doi(record, session=requests):
+    """
+    Ask the CrossRef API for the DOI of a record.
+
+    The record isn't modified, so this is safe to call from worker threads.
+
+    :param record: the record.
+    :type record: dict
+    :param session: something with a `get` method, e.g. a requests.Session.
+    :returns: str -- the DOI; '' if CrossRef has no DOI for the record,
+        or None if no answer could be had.
+    """
+    query = doi_query(record)
+    # I need to make sure a query has been built
+    if not query:
+        return None
+    payload = {
+        'query': query,
+        'rows': '1',
+        'sort': 'score',
+        'order': 'desc'
+    }
+    # We might not have an internet connection
+    # The caller should catch the exception that will raise
+    r = session.get(
+        'http://api.crossref.org/works',
+        params=payload
+    )
+    print(
+        'I got status code {} from the CrossRef API for record {}.'.format(
+            r.status_code,
+            record["ID"]
+        )
+    )
+    # Proceed if the status code was a good one
+    try:
+        if r.status_code == requests.codes.ok:
+            # The result is JSON text
+            # Items is a list in order of match score, it will have a DOI in it
+            # Catch exception raised by any sort of problem with the response
             try:
-                if r.status_code == requests.codes.ok:
-                    # The result is JSON text
-                    # Items is a list in order of match score, it will have a DOI in it
-                    # Catch exception raised by any sort of problem with the response
-                    try:
-                        doi = r.json()['message']['items'][0]['DOI']
-                        record["doi"] = doi
-                    except (IndexError, KeyError):
-                        print("I couldn't find a DOI in the JSON for record {}.".format(
-                            record["ID"]
-                            )
-                        )
-            # This deals with errors caused by encoding problems,
-            # which are fixed anyway by having the conversion
-            # to unicode done before authors are dealt with
-            except UnicodeEncodeError:
-                print(
-                    "I couldn't get a DOI. A character in record {} wasn't encoded in a way the CrossRef API understands.".format(
-                        record["ID"]
+                return r.json()['message']['items'][0]['DOI']
+            except (IndexError, KeyError):
+                print("I couldn't find a DOI in the JSON for record {}.".format(
+                    record["ID"]
                     )
                 )
+                return ''
+    # This deals with errors caused by encoding problems,
+    # which are fixed anyway by having the conversion
+    # to unicode done before authors are dealt with
+    except UnicodeEncodeError:
+        print(
+            "I couldn't get a DOI. A character in record {} wasn't encoded in a way the CrossRef API understands.".format(
+                record["ID"]
+            )
+        )
+    return None
+
+
+def get_doi(record, cache=None):
+    """
+    Get DOIs for articles from the CrossRef API.
+
+    :param record: the record.
+    :type record: dict
+    :param cache: answers from earlier runs.
+    :type cache: DoiCache
+    :returns: dict -- the modified record.
+    """
+    found, doi = False, None
+    if cache is not None:
+        found, doi = cache.get(doi_query(record))
+    if not found:
+        doi = lookup_doi(record)
+        if cache is not None and doi is not None:
+            cache.put(doi_query(record), doi)
+    if doi:
+        record["doi"] = doi
     return record
 
 
@@ -458,7 +660,7 @@ def publisher(record):
     :returns: dict -- the modified record.
     """
     if "publisher" in record:
-        if re.search('and', record["publisher"]):
+        if patterns['and'].search(record["publisher"]):
             record["publisher"] = braces(record["publisher"])
     return record
 
@@ -475,9 +677,9 @@ def edition(record):
         if record["edition"].lower().strip() in words_to_numerals:
             record["edition"] =\
                 words_to_numerals[record["edition"].lower().strip()]
-        elif re.search('\d+(st|nd|rd|th)', record["edition"].lower().strip()):
+        elif patterns['ordinal'].search(record["edition"].lower().strip()):
             record["edition"] =\
-                re.sub('(st|nd|rd|th)', '', record["edition"].lower().strip())
+                patterns['ordinal_suffix'].sub('', record["edition"].lower().strip())
     return record
 
 
@@ -495,6 +697,87 @@ def journaltitle(record):
     return record
 
 
+@functools.lru_cache(maxsize=None)
+def journal_abbreviations():
+    """
+    Open the journal abbreviation index, (re)building it if there isn't one
+    or the lists have changed.
+    The index is opened once, the first time it's needed.
+
+    :returns: journal_index.JournalIndex -- the index.
+    """
+    return journal_index.open_index()
+
+
+def abbreviate_journaltitle(record):
+    """
+    Replace the journaltitle with its abbreviation,
+    if it's in the journal abbreviation lists.
+
+    :param record: the record.
+    :type record: dict
+    :returns: dict -- the modified record.
+    """
+    if "journaltitle" in record:
+        abbreviation = journal_abbreviations().abbreviate(
+            record["journaltitle"]
+        )
+        if abbreviation is not None:
+            record["journaltitle"] = abbreviation
+    return record
+
+
+def expand_journaltitle(record):
+    """
+    Replace an abbreviated journaltitle with the journal's full name,
+    if it's in the journal abbreviation lists.
+
+    :param record: the record.
+    :type record: dict
+    :returns: dict -- the modified record.
+    """
+    if "journaltitle" in record:
+        full = journal_abbreviations().expand(record["journaltitle"])
+        if full is not None:
+            record["journaltitle"] = full
+    return record
+
+
+@functools.lru_cache(maxsize=None)
+def journal_matcher():
+    """
+    Build the index for matching journal titles to the names in the
+    journal abbreviation lists. It's built once, the first time it's needed.
+
+    :returns: journal_index.JournalMatcher -- the index.
+    """
+    return journal_index.JournalMatcher.from_index(journal_abbreviations())
+
+
+@memoize
+def canonical_journaltitle(title):
+    """
+    str -> str
+    Return the name in the journal abbreviation lists which `title` is
+    most like, or `title` if there isn't one like it.
+    """
+    return journal_matcher().normalize(title)
+
+
+def normalize_journaltitle(record):
+    """
+    Replace the journaltitle with the full name of the journal it's
+    most like in the journal abbreviation lists, if there is one.
+
+    :param record: the record.
+    :type record: dict
+    :returns: dict -- the modified record.
+    """
+    if "journaltitle" in record:
+        record["journaltitle"] = canonical_journaltitle(record["journaltitle"])
+    return record
+
+
 def case_title(record):
     """
     Put titles in titlecase for English records.
@@ -507,11 +790,11 @@ def case_title(record):
     """
     if "language" not in record or record["language"] in english_identifiers:
         if "title" in record:
-            record["title"] = titlecase.titlecase(record["title"])
+            record["title"] = title_case(record["title"])
         if "subtitle" in record:
-            record["subtitle"] = titlecase.titlecase(record["subtitle"])
+            record["subtitle"] = title_case(record["subtitle"])
         if "booktitle" in record:
-            record["booktitle"] = titlecase.titlecase(record["booktitle"])
+            record["booktitle"] = title_case(record["booktitle"])
     return record
 
 
@@ -567,7 +850,7 @@ def remove_epub(record):
     :returns: dict -- the modified record.
     """
     if "epub" in record:
-        del record["issn"]
+        del record["epub"]
     return record
 
 
@@ -678,13 +961,13 @@ def remove_ampersand(record):
     :returns: dict -- the modified record.
     """
     if "booktitle" in record:
-        record["booktitle"] = re.sub('\\\\&', 'and', record["booktitle"])
+        record["booktitle"] = patterns['escaped_ampersand'].sub('and', record["booktitle"])
     if "journaltitle" in record:
-        record["journaltitle"] = re.sub('\\\\&', 'and', record["journaltitle"])
+        record["journaltitle"] = patterns['escaped_ampersand'].sub('and', record["journaltitle"])
     if "subtitle" in record:
-        record["subtitle"] = re.sub('\\\\&', 'and', record["subtitle"])
+        record["subtitle"] = patterns['escaped_ampersand'].sub('and', record["subtitle"])
     if "title" in record:
-        record["title"] = re.sub('\\\\&', 'and', record["title"])
+        record["title"] = patterns['escaped_ampersand'].sub('and', record["title"])
     return record
 
 
@@ -696,14 +979,8 @@ def escape_characters(record):
     :type record: dict
     :returns: dict -- the modified record.
     """
-    list_of_characters = ['&', '%', '_']
     for val in record:
-        for c in list_of_characters:
-            record[val] = re.sub(
-                '(?<!\\\\){}'.format(c),
-                '\{}'.format(c),
-                record[val]
-            )
+        record[val] = escape_reserved(record[val])
     return record
 
 
@@ -732,7 +1009,7 @@ def protect(s):
     Take a string and return a string where words containing capital letters
     (after the first word) are protected with braces.
     """
-    needs_protection = re.findall('(?<=\s)\S*[A-Z]+\S*|(?<=:\s)\S+', s)
+    needs_protection = patterns['needs_protection'].findall(s)
     for word in needs_protection:
         s = re.sub(word, '{{{}}}'.format(word), s)
     return s
@@ -784,3 +1061,49 @@ def remove_booktitle(record):
     if "booktitle" in record:
         del record["booktitle"]
     return record
+
+
+# Fields deleted outright by each removal step.
+# Removals don't depend on the other steps,
+# so a chain of steps can do them all at once.
+removed_fields =\
+    {
+        'citeulike': {'citeulike-article-id', 'priority', 'posted-at'},
+        'jstor': {
+            'jstor_articletype',
+            'jstor_formatteddate',
+            'jstor_issuetitle'
+        },
+        'remove_abstract': {'abstract'},
+        'remove_booktitle': {'booktitle'},
+        'remove_copyright': {'copyright'},
+        'remove_epub': {'epub'},
+        'remove_ISBN': {'isbn'},
+        'remove_ISSN': {'issn'},
+        'remove_keyword': {'keyword', 'keywords'},
+        'remove_link': {'link'},
+        'remove_series': {'series'}
+    }
+
+# Steps which add a field in `removed_fields`,
+# so removals can't be done before them
+adds_removed_fields = {'booktitle'}
+
+# Steps which apply a str -> str function to every field.
+# Neighbouring ones can share one pass over the fields.
+field_transforms =\
+    {
+        'active_quotes': activate_quotes,
+        'dashes': replace_dashes,
+        'escape_characters': escape_reserved
+    }
+
+# The memoized str -> str transforms, by name
+memoized =\
+    {
+        'canonical_journaltitle': canonical_journaltitle,
+        'full_range': full_range,
+        'remove_outer_braces': remove_outer_braces,
+        'title_case': title_case,
+        'title_name': title_name
+    }
@@ -1,103 +1,822 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import itertools
+import json
+import os
 import re
 import shutil
+import stat
 import sys
+import tempfile
+import time
 
 import cb_customs
 
+import bibtexparser.customization
+from bibtexparser.bibdatabase import BibDatabase
 from bibtexparser.bparser import BibTexParser
 from bibtexparser.bwriter import BibTexWriter
 from bibtexparser.customization import *
 
 
-def fix_keys(l):
-    """ list -> list
-    Take a list that represents lines.
+# Compiled once for fix_keys
+keyless_entry = re.compile(r'@\w+\s*{,?')
+# Blocks which define things for the whole file rather than being entries
+non_entry = re.compile(r'@\s*(comment|preamble|string)\b', re.IGNORECASE)
+non_word = re.compile(r'\W+')
+
+
+# Dummy citekeys in --stream mode from stdin, where the keys further on
+# aren't known: apart from 'Foo', which dummy keys of the whole file use.
+# Only word characters, so that converting the output again keeps them.
+stream_dummy_prefix = 'FooStream'
+
+
+class DummyKeys(object):
+    """Hand out dummy citekeys: 'Foo1', 'Foo2', and so on
+
+    The keys in `used`, and keys passed to `add` (the ones fix_keys has seen
+    so far), are skipped, so no two entries of a run get the same key.
+
+    :param used: keys the bibliography already has, e.g. from `citekeys`
+    :param prefix: what the dummy keys start with
+    """
+
+    def __init__(self, used=(), prefix='Foo'):
+        self.used = set(used)
+        self.prefix = prefix
+        self.count = itertools.count(1)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        key = self.prefix + str(next(self.count))
+        while key in self.used:
+            key = self.prefix + str(next(self.count))
+        self.used.add(key)
+        return key
+
+    def add(self, key):
+        self.used.add(key)
+
+
+def citekeys(lines):
+    """ iterable -> generator
+    Yield the keys fix_keys will leave in lines, with their spaces removed.
+    >>> list(citekeys(['@book{foo bar,', '@article{', '}']))
+    ['foobar']
+    """
+    for line in lines:
+        stripped = line.strip()
+        if stripped.startswith('@') and not keyless_entry.fullmatch(stripped):
+            start = line.find('{') + 1
+            if start:
+                yield non_word.sub('', line[start:])
+
+
+def fix_keys(lines, dummy_keys=None):
+    """ iterable -> generator
+    Take lines (without line endings), e.g. from a file.
     Find lines which are the start of a bibtex entry without a key.
     Add dummy keys to those lines.
     Remove spaces from keys.
-    >>> fix_keys(
-        ['@book{foo bar,', '@article{', '    Author = {Thomas Hodgson}', '}']
-    )
+    Only lines starting with '@' are looked at; the rest are passed on.
+    Without `dummy_keys`, all the lines are read first, so that no dummy key
+    is one which comes later. Pass the same `dummy_keys` to calls on
+    different parts of one file to keep the dummy keys distinct.
+    >>> list(fix_keys(
+    ...     ['@book{foo bar,', '@article{', '    Author = {Thomas Hodgson}', '}']
+    ... ))
     ['@book{foobar,', '@article{Foo1,', '    Author = {Thomas Hodgson}', '}']
+    >>> list(fix_keys(['@article{', '}', '@book{Foo1,', '}']))
+    ['@article{Foo2,', '}', '@book{Foo1,', '}']
     """
-    i = 1
-    j = 0
-    while j < len(l):
-        if re.fullmatch('@\\w+\\s*{,{0,1}', l[j].strip()):
-            l[j] = l[j][:l[j].find('{')+1] + 'Foo' + str(i) + ','
-            i += 1
-        elif re.match('@', l[j].strip()):
-            # Find where the key starts
-            start = re.search('{', l[j]).end()
-            # Get rid of any non word characters
-            key = re.sub('\W+', '', l[j][start:])
-            # Put it back together; add a comma which will have been removed
-            l[j] = l[j][:start] + key + ','
-        j += 1
-    return l
+    if dummy_keys is None:
+        lines = list(lines)
+        dummy_keys = DummyKeys(citekeys(lines))
+    for line in lines:
+        stripped = line.strip()
+        if stripped.startswith('@'):
+            start = line.find('{') + 1
+            if keyless_entry.fullmatch(stripped):
+                line = line[:start] + next(dummy_keys) + ','
+            elif start:
+                # Get rid of any non word characters
+                key = non_word.sub('', line[start:])
+                dummy_keys.add(key)
+                # Put it back together; add a comma which will have been removed
+                line = line[:start] + key + ','
+        yield line
 
 
-def customizations(record):
-    """Use some functions delivered by the library
+def iter_entries(lines):
+    """Split lines into the entries of a bibliography
 
-    :param record: a record
-    :returns: -- customized record
+    A new entry starts at each line beginning with '@' which is outside
+    the braces of the previous entry. Anything before the first '@' is
+    dropped.
+
+    :param lines: an iterable of lines, e.g. an open file
+    :returns: -- a generator of lists of lines without line endings
+    """
+    entry = None
+    depth = 0
+    for line in lines:
+        line = line.rstrip('\n')
+        if entry is None:
+            # Find the start of the first record
+            start = line.find('@')
+            if start < 0:
+                continue
+            line = line[start:]
+            entry = []
+        elif depth <= 0 and line.lstrip().startswith('@'):
+            yield entry
+            entry = []
+            depth = 0
+        entry.append(line)
+        depth += line.count('{') - line.count('}')
+    if entry is not None:
+        yield entry
+
+
+# The number of entries converted together in --stream mode
+stream_batch_size = 100
+
+
+def stream(lines, out, find_dois=None, batch_size=stream_batch_size,
+           customize=None, dummy_keys=None):
+    """Convert a bibliography a batch of entries at a time
+
+    Each batch is parsed, customized, and written before the next is read,
+    so memory use doesn't grow with the size of the bibliography.
+    Entries are written in the order they come in.
+
+    :param lines: an iterable of lines, e.g. an open file
+    :param out: a file to write the converted entries to
+    :param find_dois: called with each batch of records before it's written
+    :param batch_size: the number of entries in a batch
+    :param customize: called with each batch of parsed records to customize
+        them all at once, instead of `customizations` being called on each
+    :param dummy_keys: a DummyKeys, e.g. with the keys of the whole file;
+        by default the keys start with `stream_dummy_prefix`
+    :returns: -- the number of entries written
+    """
+    parser = BibTexParser(
+        customization=None if customize else customizations,
+        ignore_nonstandard_types=False
+    )
+    parser.expect_multiple_parse = True
+    database = parser.bib_database
+    writer = BibTexWriter()
+    writer.order_entries_by = None
+    if dummy_keys is None:
+        dummy_keys = DummyKeys(prefix=stream_dummy_prefix)
+    known_strings = dict(database.strings)
+    written = 0
+    after_entry = False
+    entries = iter_entries(lines)
+    while True:
+        batch = list(itertools.islice(entries, batch_size))
+        if not batch:
+            break
+        parser.parse('\n'.join(
+            '\n'.join(fix_keys(entry, dummy_keys)) for entry in batch
+        ))
+        if customize is not None:
+            database.entries = customize(database.entries)
+        if find_dois is not None:
+            find_dois(database.entries)
+        # Only write @string definitions which are new in this batch
+        done = BibDatabase()
+        done.entries = database.entries
+        done.comments = database.comments
+        done.preambles = database.preambles
+        for name, value in database.strings.items():
+            if known_strings.get(name) is not value:
+                done.strings[name] = value
+        known_strings = dict(database.strings)
+        output = writer.write(done)
+        if output:
+            if after_entry:
+                out.write(writer.entry_separator)
+            out.write(output)
+            after_entry = bool(done.entries)
+        written += len(done.entries)
+        database.entries = []
+        database.comments = []
+        database.preambles = []
+    return written
+
+
+def make_backup(path):
+    """Keep the current contents of path at path.backup
+
+    The backup is a hard link to the original, so nothing is copied; this is
+    only safe because the original is replaced (see `replacing`) rather than
+    written to. Where hard links aren't supported the file is copied. If path
+    is a symbolic link, the file it points to is backed up, next to it.
+    """
+    path = os.path.realpath(path)
+    backup = path + '.backup'
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(backup)
+    try:
+        os.link(path, backup)
+    except OSError:
+        shutil.copy(path, backup)
+
+
+@contextlib.contextmanager
+def replacing(path, like=None):
+    """Open a temporary file, which replaces path once it has been written
+
+    The temporary file is in the same directory, so the rename is atomic: if
+    the conversion fails or is killed, path is left as it was and no
+    half-written file is left behind. If path is a symbolic link, the file
+    it points to is replaced, and the link kept. The new file has the
+    permissions of the old one, or of `like` if there was no old one.
+    """
+    path = os.path.realpath(path)
+    directory, name = os.path.split(path)
+    fd, temporary = tempfile.mkstemp(
+        prefix='.' + name + '.', suffix='.tmp', dir=directory
+    )
+    try:
+        with open(fd, 'w', encoding='utf-8') as out:
+            yield out
+            out.flush()
+            os.fsync(out.fileno())
+        # mkstemp makes files only the owner can read
+        for original in (path, like):
+            if original is not None and os.path.exists(original):
+                os.chmod(temporary, stat.S_IMODE(os.stat(original).st_mode))
+                break
+        os.replace(temporary, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temporary)
+        raise
+
+
+def entry_blocks(lines):
+    """The text of each block of a bibliography, after fix_keys
+
+    :param lines: a list of lines without line endings
+    :returns: -- a list of str
+    """
+    lines = list(lines)
+    dummy_keys = DummyKeys(citekeys(lines))
+    return [
+        '\n'.join(fix_keys(block, dummy_keys)) for block in iter_entries(lines)
+    ]
+
+
+def code_fingerprint():
+    """A hash of this script and cb_customs, and the bibtexparser version
+
+    If any of them changes, earlier conversions may no longer be what a
+    conversion would give.
+    """
+    digest = hashlib.sha1(bibtexparser.__version__.encode('utf-8'))
+    for module in (sys.modules[__name__], cb_customs):
+        with open(module.__file__, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def block_fingerprint(settings, blocks):
+    """A hash of settings and of the blocks which aren't entries"""
+    return hashlib.sha1(json.dumps(
+        [settings, [block for block in blocks if non_entry.match(block)]]
+    ).encode('utf-8')).hexdigest()
+
+
+def block_digest(block):
+    return hashlib.sha1(block.encode('utf-8')).hexdigest()
+
+
+def incremental(lines, manifest_path, settings, find_dois=None,
+                customize=None, like=None):
+    """Convert a bibliography, reusing the output of an earlier conversion
+
+    The manifest maps a hash of the text of each entry (after fix_keys) to
+    what it was converted to. Only entries which aren't in the manifest are
+    parsed and customized. The manifest is thrown away if `settings`, the
+    code (see code_fingerprint), or the @string, @preamble, and @comment
+    blocks have changed, and is rewritten
+    with this run's entries. The result is the same as converting the whole
+    bibliography.
+
+    The output usually replaces the input, so the text of each converted
+    entry is recorded too, as converted already. Entries whose DOI lookup
+    got no answer (e.g. offline) aren't recorded, so they are tried again.
+
+    :param lines: an iterable of lines, e.g. an open file
+    :param manifest_path: where the manifest is kept
+    :param settings: anything (JSON-serializable) which affects the output,
+        e.g. the names of the customizations
+    :param find_dois: called with the records which were customized; it
+        can return the records for which no answer could be had
+    :param customize: called with the parsed records to customize them all
+        at once, instead of `customizations` being called on each
+    :param like: a file whose permissions a new manifest gets, e.g. the
+        bibliography
+    :returns: -- the converted bibliography, and the number of entries which
+        were reused
     """
+    settings = [settings, code_fingerprint()]
+    blocks = entry_blocks(lines)
+    fingerprint = block_fingerprint(settings, blocks)
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    known = {}
+    if fingerprint in manifest.get('fingerprints', []):
+        known = manifest.get('entries', {})
+    parser = BibTexParser(
+        customization=None if customize else customizations,
+        ignore_nonstandard_types=False
+    )
+    parser.expect_multiple_parse = True
+    database = parser.bib_database
+    # For each block: its hash, entries, comments, and preambles.
+    # Entries parsed in this run are records until they are written.
+    done = []
+    for block in blocks:
+        digest = block_digest(block)
+        if digest in known and not non_entry.match(block):
+            done.append((digest, known[digest]['entries'],
+                         known[digest]['comments'], []))
+            continue
+        entries = len(database.entries)
+        comments = len(database.comments)
+        preambles = len(database.preambles)
+        parser.parse(block)
+        done.append((
+            digest,
+            database.entries[entries:],
+            database.comments[comments:],
+            database.preambles[preambles:]
+        ))
+    records = database.entries
+    if customize is not None and records:
+        customized = iter(customize(records))
+        for _, entries, _, _ in done:
+            if entries and isinstance(entries[0], dict):
+                entries[:] = [next(customized) for _ in entries]
+        records = [
+            record for _, entries, _, _ in done
+            for record in entries if isinstance(record, dict)
+        ]
+    retry = set()
+    if find_dois is not None and records:
+        retry = {id(record) for record in find_dois(records) or ()}
+    writer = BibTexWriter()
+    writer.contents = ['entries']
+    single = BibDatabase()
+    reused = 0
+    entries = []
+    database.comments = []
+    database.preambles = []
+    manifest = {'fingerprints': [fingerprint], 'entries': {}}
+    # Entries as [sort key, text, whether to record them]
+    for digest, block_entries, comments, preambles in done:
+        keep = True
+        if block_entries and isinstance(block_entries[0], dict):
+            written = []
+            for record in block_entries:
+                single.entries = [record]
+                written.append([
+                    BibDatabase.entry_sort_key(record, writer.order_entries_by),
+                    writer.write(single)
+                ])
+                keep = keep and id(record) not in retry
+            block_entries = written
+        elif block_entries:
+            reused += len(block_entries)
+        entries.extend(entry + [keep] for entry in block_entries)
+        database.comments.extend(comments)
+        database.preambles.extend(preambles)
+        if keep:
+            manifest['entries'][digest] = {
+                'entries': block_entries,
+                'comments': comments
+            }
+    database.entries = []
+    writer.contents = ['comments', 'preambles', 'strings']
+    output = writer.write(database)
+    # Sort by key as BibTexWriter does
+    entries.sort(key=lambda entry: tuple(entry[0]))
+    output += writer.entry_separator.join(text for _, text, _ in entries)
+    # Next time the input is likely to be this output
+    output_blocks = entry_blocks(output.split('\n'))
+    output_entries = [
+        block for block in output_blocks if not non_entry.match(block)
+    ]
+    if len(output_entries) == len(entries):
+        manifest['fingerprints'].append(
+            block_fingerprint(settings, output_blocks)
+        )
+        for block, (key, text, keep) in zip(output_entries, entries):
+            if keep:
+                manifest['entries'].setdefault(block_digest(block), {
+                    'entries': [[key, text]],
+                    'comments': []
+                })
+    with replacing(manifest_path, like) as f:
+        json.dump(manifest, f)
+    return output, reused
+
+
+# The names of the customizations, in the order they are applied.
+# A file given with --steps replaces this.
+chain = [
     # This needs to come before authors are dealt with
     # otherwise there are encoding problems
-    record = convert_to_unicode(record)
-    record = author(record)
-    record = editor(record)
+    'convert_to_unicode',
+    'author',
+    'editor',
     # This is needed after `author` is called to allow writing
-    record = cb_customs.join_author_editor(record)
-    record = cb_customs.titlecase_name(record)
-    record = cb_customs.remove_booktitle(record)
-    record = cb_customs.language(record)
-    record = cb_customs.case_title(record)
-    record = cb_customs.journaltitle(record)
+    'join_author_editor',
+    'titlecase_name',
+    'remove_booktitle',
+    'language',
+    'case_title',
+    'journaltitle',
     # This should come after `journaltitle`is called
-    record = cb_customs.add_definite_to_journaltitles(record)
-    record = cb_customs.remove_pages_from_books_and_collections(record)
-    record = cb_customs.non_page_hyphens(record)
-    record = cb_customs.dashes(record)
-    record = cb_customs.biblatex_page_ranges(record)
-    record = cb_customs.remove_abstract(record)
-    record = cb_customs.remove_ISBN(record)
-    record = cb_customs.remove_ISSN(record)
-    record = cb_customs.remove_epub(record)
-    record = cb_customs.remove_copyright(record)
-    record = cb_customs.remove_publisher(record)
-    record = cb_customs.remove_link(record)
-    record = cb_customs.escape_characters(record)
-    record = cb_customs.remove_ampersand(record)
-    record = cb_customs.jstor(record)
-    record = cb_customs.citeulike(record)
-    record = cb_customs.edition(record)
-    record = cb_customs.multivolume(record)
-    record = cb_customs.publisher(record)
-    record = cb_customs.strip_doi(record)
-    record = cb_customs.remove_keyword(record)
-    record = cb_customs.empty_fields(record)
-    record = cb_customs.remove_protection(record)
-    record = cb_customs.active_quotes(record)
-    record = cb_customs.subtitles(record)
-    record = cb_customs.remove_series(record)
-    if not args.nodoi:
-        try:
-            record = cb_customs.get_doi(record)
-        # If there is a connection error stop trying to get DOIs
-        except cb_customs.requests.exceptions.ConnectionError:
-            if args.verbose:
-                print(
-                    "I couldn't connect to the CrossRef API. "
-                    "Perhaps you are not connected to the internet?"
+    'add_definite_to_journaltitles',
+    'remove_pages_from_books_and_collections',
+    'non_page_hyphens',
+    'dashes',
+    'biblatex_page_ranges',
+    'remove_abstract',
+    'remove_ISBN',
+    'remove_ISSN',
+    'remove_epub',
+    'remove_copyright',
+    'remove_publisher',
+    'remove_link',
+    'escape_characters',
+    'remove_ampersand',
+    'jstor',
+    'citeulike',
+    'edition',
+    'multivolume',
+    'publisher',
+    'strip_doi',
+    'remove_keyword',
+    'empty_fields',
+    'remove_protection',
+    'active_quotes',
+    'subtitles',
+    'remove_series'
+]
+
+# Customizations which aren't in the chain but can be named in --steps
+optional_steps = [
+    'abbreviate_journaltitle',
+    'expand_journaltitle',
+    'normalize_journaltitle',
+    'booktitle',
+    'philpapers',
+    'protect_capitalisation',
+    'get_doi'
+]
+
+# Customizations from the library which don't look at the fields
+# cb_customs removes
+transparent_steps = {convert_to_unicode, author, editor}
+
+
+def remove_fields(fields):
+    """Make a step which deletes a set of fields from a record"""
+    def step(record):
+        for field in fields.intersection(record):
+            del record[field]
+        return record
+    return step
+
+
+def transform_fields(transforms):
+    """Make a step which applies str -> str functions to every field"""
+    def step(record):
+        for field in record:
+            value = record[field]
+            for transform in transforms:
+                value = transform(value)
+            record[field] = value
+        return record
+    return step
+
+
+def compile_plan(steps):
+    """Turn a chain of customizations into a shorter chain with the same result
+
+    Removal steps are merged into one set of fields deleted as early as
+    possible, and neighbouring steps which transform every field are merged
+    into a single pass over the fields.
+
+    :param steps: a list of customizations
+    :returns: -- a list of customizations
+    """
+    # Sets are removals, lists are field transforms
+    removals = set()
+    plan = [removals]
+    for step in steps:
+        name = step.__name__
+        if name in cb_customs.removed_fields:
+            removals.update(cb_customs.removed_fields[name])
+        elif name in cb_customs.field_transforms:
+            if not isinstance(plan[-1], list):
+                plan.append([])
+            plan[-1].append(cb_customs.field_transforms[name])
+        else:
+            plan.append(step)
+            if (
+                step.__module__ != cb_customs.__name__
+                and step not in transparent_steps
+            ) or name in cb_customs.adds_removed_fields:
+                # Removals after this step have to stay after it
+                removals = set()
+                plan.append(removals)
+    compiled = []
+    for step in plan:
+        if isinstance(step, set):
+            if step:
+                compiled.append(remove_fields(frozenset(step)))
+        elif isinstance(step, list):
+            compiled.append(transform_fields(tuple(step)))
+        else:
+            compiled.append(step)
+    return compiled
+
+
+def find_step(name):
+    """Find the customization with a given name
+
+    Only the names in `chain` and `optional_steps` are customizations.
+    Functions in cb_customs are looked for first, then those in bibtexparser.
+
+    >>> find_step('title_case')
+    Traceback (most recent call last):
+    ValueError: I don't know a customization called 'title_case'.
+
+    :param name: the name of a customization
+    :returns: -- the function
+    """
+    if name not in chain and name not in optional_steps:
+        raise ValueError(
+            "I don't know a customization called '{}'.".format(name)
+        )
+    for module in (cb_customs, bibtexparser.customization):
+        step = getattr(module, name, None)
+        if callable(step):
+            return step
+    raise ValueError("I don't know a customization called '{}'.".format(name))
+
+
+def load_steps(path):
+    """Read the names of customizations from a file
+
+    The file has one name per line. Blank lines and lines starting with '#'
+    are ignored.
+
+    :param path: path to the file
+    :returns: -- a list of names
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def profiled(step, timings):
+    """Wrap a customization so the time spent in it is recorded
+
+    :param step: a customization
+    :param timings: a dict from names to [seconds, calls], added to in place
+    :returns: -- the wrapped customization
+    """
+    totals = timings.setdefault(step.__name__, [0.0, 0])
+
+    def timed(record):
+        start = time.perf_counter()
+        record = step(record)
+        totals[0] += time.perf_counter() - start
+        totals[1] += 1
+        return record
+    timed.__name__ = step.__name__
+    return timed
+
+
+def print_profile(timings):
+    """Print a table of where the time went, slowest first, to stderr
+
+    :param timings: a dict from names to [seconds, calls]
+    """
+    total = sum(seconds for seconds, calls in timings.values()) or 1.0
+    print('{:<42} {:>9} {:>11} {:>11} {:>6}'.format(
+        'step', 'calls', 'seconds', 'µs/call', '%'
+    ), file=sys.stderr)
+    for name, (seconds, calls) in sorted(
+        timings.items(), key=lambda item: item[1][0], reverse=True
+    ):
+        print('{:<42} {:>9} {:>11.4f} {:>11.1f} {:>6.1f}'.format(
+            name,
+            calls,
+            seconds,
+            seconds / calls * 1e6 if calls else 0.0,
+            seconds / total * 100
+        ), file=sys.stderr)
+
+
+def print_memo_stats():
+    """Print how often the memoized transforms of cb_customs were reused"""
+    for name, function in sorted(cb_customs.memoized.items()):
+        info = function.cache_info()
+        calls = info.hits + info.misses
+        if calls:
+            print(
+                "I reused {} of {} results of {} ({} hits, {} misses, "
+                "{} remembered).".format(
+                    info.hits, calls, name, info.hits, info.misses,
+                    info.currsize
                 )
-            args.nodoi = True
+            )
+
+
+def build_plan(names, timings=None):
+    """Make the list of customizations `customizations` applies
+
+    If `timings` is given every step is timed on its own, so the steps
+    are wrapped rather than compiled together.
+
+    :param names: the names of the customizations, in order
+    :param timings: a dict to record time spent in each step, or None
+    :returns: -- a list of customizations
+    """
+    steps = [find_step(name) for name in names]
+    if timings is not None:
+        return [profiled(step, timings) for step in steps]
+    return compile_plan(steps)
+
+
+plan = build_plan(chain)
+
+
+def customizations(record):
+    """Use some functions delivered by the library
+
+    :param record: a record
+    :returns: -- customized record
+    """
+    for step in plan:
+        record = step(record)
     return record
 
+
+# The time spent in each step by a --jobs worker, if it's profiling
+worker_timings = None
+
+
+def start_worker(names, profile=False):
+    """Set up a process of the --jobs pool to apply the given customizations
+
+    :param names: the names of the customizations, in order
+    :param profile: whether to time each step
+    """
+    global plan, worker_timings
+    worker_timings = collections.OrderedDict() if profile else None
+    plan = build_plan(names, worker_timings)
+
+
+def customize_chunk(records):
+    """Customize a list of records in a worker process
+
+    :param records: a list of records
+    :returns: -- the customized records, and the time spent in each step
+        since the last chunk (or None if the worker isn't profiling)
+    """
+    records = [customizations(record) for record in records]
+    timings = None
+    if worker_timings is not None:
+        timings = {name: list(totals) for name, totals in worker_timings.items()}
+        for totals in worker_timings.values():
+            totals[0], totals[1] = 0.0, 0
+    return records, timings
+
+
+def customize_parallel(records, pool, jobs, timings=None):
+    """Customize records in a process pool, keeping their order
+
+    :param records: a list of records which haven't been customized
+    :param pool: a concurrent.futures.ProcessPoolExecutor set up by
+        `start_worker`
+    :param jobs: the number of processes in the pool
+    :param timings: a dict to add the workers' step timings to, or None
+    :returns: -- a list of customized records
+    """
+    # A few chunks per process evens out the load
+    size = max(1, -(-len(records) // (jobs * 4)))
+    chunks = [records[i:i + size] for i in range(0, len(records), size)]
+    customized = []
+    for done, chunk_timings in pool.map(customize_chunk, chunks):
+        customized.extend(done)
+        if timings is not None and chunk_timings:
+            for name, (seconds, calls) in chunk_timings.items():
+                totals = timings.setdefault(name, [0.0, 0])
+                totals[0] += seconds
+                totals[1] += calls
+    return customized
+
+
+def resolve_dois(entries, workers=1, verbose=False, cache=None,
+                 unanswered=None):
+    """Find DOIs for articles which don't have one
+
+    Answers already in the cache are used without asking CrossRef.
+    The remaining lookups are done by a pool of threads sharing one
+    keep-alive session, and the DOIs are written back to the records
+    (and to the cache) as they arrive.
+
+    :param entries: a list of customized records
+    :param workers: the number of lookups to have in flight at once
+    :param verbose: whether to print messages
+    :param cache: a cb_customs.DoiCache, or None
+    :param unanswered: a list to which the records CrossRef gave no answer
+        for are added, e.g. because it couldn't be reached
+    :returns: -- the number of lookups made
+    """
+    pending = []
+    for record in entries:
+        query = cb_customs.doi_query(record)
+        if not query:
+            continue
+        found, doi = cache.get(query) if cache is not None else (False, None)
+        if not found:
+            pending.append((query, record))
+        elif doi:
+            record["doi"] = doi
+    if verbose and cache is not None:
+        print(
+            "I found {} DOI answers in the cache at {}."
+            .format(cache.hits, cache.path)
+        )
+    if not pending:
+        return 0
+    session = cb_customs.crossref_session(workers)
+    done = 0
+    answered = set()
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(cb_customs.lookup_doi, record, session): (query, record)
+            for query, record in pending
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                doi = future.result()
+            # If there is a connection error stop trying to get DOIs
+            except cb_customs.requests.exceptions.ConnectionError:
+                if verbose:
+                    print(
+                        "I couldn't connect to the CrossRef API. "
+                        "Perhaps you are not connected to the internet?"
+                    )
+                for f in futures:
+                    f.cancel()
+                break
+            done += 1
+            query, record = futures[future]
+            if doi:
+                record["doi"] = doi
+            if doi is not None:
+                answered.add(id(record))
+                if cache is not None:
+                    cache.put(query, doi)
+    session.close()
+    if unanswered is not None:
+        unanswered.extend(
+            record for _, record in pending if id(record) not in answered
+        )
+    if verbose:
+        elapsed = time.perf_counter() - start
+        print(
+            "I looked up {} DOIs in {:.2f} seconds ({:.1f} lookups/sec)."
+            .format(done, elapsed, done / elapsed if elapsed else 0.0)
+        )
+    return done
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -110,6 +829,73 @@ if __name__ == "__main__":
         action='store_true',
         help="Don't look for DOIs from CrossRef"
     )
+    parser.add_argument(
+        '--doi-workers',
+        dest='doiworkers',
+        type=int,
+        default=4,
+        metavar='N',
+        help="Number of CrossRef lookups to make at once (default: 4)"
+    )
+    parser.add_argument(
+        '--doi-cache',
+        dest='doicache',
+        default=os.path.join('~', '.cache', 'convertbibliography'),
+        metavar='DIR',
+        help="Directory for remembering CrossRef answers between runs"
+    )
+    parser.add_argument(
+        '--no-doi-cache',
+        dest='nodoicache',
+        action='store_true',
+        help="Don't remember CrossRef answers between runs"
+    )
+    parser.add_argument(
+        '--doi-cache-days',
+        dest='doicachedays',
+        type=float,
+        default=90,
+        metavar='DAYS',
+        help="How long a remembered CrossRef answer is good for (default: 90)"
+    )
+    parser.add_argument(
+        '--doi-cache-size',
+        dest='doicachesize',
+        type=int,
+        default=100000,
+        metavar='N',
+        help="How many CrossRef answers to remember (default: 100000)"
+    )
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help="Convert and write a batch of entries at a time "
+        "to save memory; entries keep their input order"
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help="Only convert entries which have changed since the last run, "
+        "keeping a manifest next to the input file"
+    )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        metavar='N',
+        help="Number of processes to customize records in (default: 1)"
+    )
+    parser.add_argument(
+        '--steps',
+        metavar='FILE',
+        help="File listing the customizations to apply, one name per line"
+    )
+    parser.add_argument(
+        '--profile-steps',
+        dest='profilesteps',
+        action='store_true',
+        help="Print the time spent in each customization at the end"
+    )
     parser.add_argument(
         '--verbose',
         dest='verbose',
@@ -117,43 +903,145 @@ if __name__ == "__main__":
         help="Print messages"
     )
     args = parser.parse_args()
+    if args.incremental and (args.stream or not args.input):
+        parser.error("--incremental needs --input and can't be used with --stream")
+    timings = collections.OrderedDict() if args.profilesteps else None
+    try:
+        names = load_steps(args.steps) if args.steps else chain
+        plan = build_plan(names, timings)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
     if args.input:
         bib = args.input
         try:
-            shutil.copy(bib, bib + '.backup')
+            make_backup(bib)
             if args.verbose:
                 print(
                     "I have made a backup of the orignal file at {}.backup"
                     .format(bib)
                 )
-            with open(bib, 'r', encoding='utf-8') as biblatex:
-                content = biblatex.read()
         except FileNotFoundError:
             if args.verbose:
                 print("I couldn't find the file {}.".format(bib))
             sys.exit()
-    else:
-        content = sys.stdin.read()
-    # Find the start of the first record
+    cache = None
+    if not args.nodoi and not args.nodoicache:
+        cache = cb_customs.DoiCache(
+            os.path.expanduser(args.doicache),
+            ttl=args.doicachedays * 24 * 60 * 60,
+            max_entries=args.doicachesize
+        )
+
+    def find_dois(entries):
+        start = time.perf_counter()
+        unanswered = []
+        lookups = resolve_dois(
+            entries,
+            workers=max(args.doiworkers, 1),
+            verbose=args.verbose,
+            cache=cache,
+            unanswered=unanswered
+        )
+        if timings is not None:
+            totals = timings.setdefault('resolve_dois', [0.0, 0])
+            totals[0] += time.perf_counter() - start
+            totals[1] += lookups
+        return unanswered
+
+    pool = None
+    customize = None
+    if args.jobs > 1:
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.jobs,
+            initializer=start_worker,
+            initargs=(names, args.profilesteps)
+        )
+
+        def customize(records):
+            return customize_parallel(records, pool, args.jobs, timings)
+
     try:
-        start = re.search('@', content).start()
-    except AttributeError:
-        if args.verbose:
-            print("The file I was given didn't contain any records.")
-        sys.exit()
-    content = content[start:].split('\n')
-    # Provide dummy citekeys
-    content = fix_keys(content)
-    fixed_content = '\n'.join(content)
-    bibliography = BibTexParser(
-        fixed_content,
-        customization=customizations,
-        ignore_nonstandard_types=False
-        # Otherwise bibtexparser will complain if I give it a collection
-    )
-    output = BibTexWriter().write(bibliography)
-    if args.input:
-        with open(bib, 'w', encoding='utf-8') as biblatex:
-            biblatex.write(output)
-    else:
-        sys.stdout.write(output)
+        if args.stream:
+            if args.input:
+                # Only the keys are kept, so that dummy keys are the same as
+                # without --stream
+                with open(bib, 'r', encoding='utf-8') as source:
+                    used = set(citekeys(source))
+                with open(bib, 'r', encoding='utf-8') as source, \
+                        replacing(bib) as out:
+                    written = stream(
+                        source,
+                        out,
+                        find_dois=None if args.nodoi else find_dois,
+                        customize=customize,
+                        dummy_keys=DummyKeys(used)
+                    )
+            else:
+                written = stream(
+                    sys.stdin,
+                    sys.stdout,
+                    find_dois=None if args.nodoi else find_dois,
+                    customize=customize
+                )
+            if not written and args.verbose:
+                print("The file I was given didn't contain any records.")
+        else:
+            if args.input:
+                with open(bib, 'r', encoding='utf-8') as biblatex:
+                    content = biblatex.read()
+            else:
+                content = sys.stdin.read()
+            # Find the start of the first record
+            try:
+                start = re.search('@', content).start()
+            except AttributeError:
+                if args.verbose:
+                    print("The file I was given didn't contain any records.")
+                sys.exit()
+            if args.incremental:
+                output, reused = incremental(
+                    content[start:].split('\n'),
+                    bib + '.manifest',
+                    [names, args.nodoi],
+                    find_dois=None if args.nodoi else find_dois,
+                    customize=customize,
+                    like=bib
+                )
+                if args.verbose:
+                    print(
+                        "I reused the conversion of {} unchanged entries."
+                        .format(reused)
+                    )
+                with replacing(bib) as biblatex:
+                    biblatex.write(output)
+            else:
+                # Provide dummy citekeys
+                fixed_content = '\n'.join(
+                    fix_keys(content[start:].split('\n'))
+                )
+                bibliography = BibTexParser(
+                    fixed_content,
+                    customization=None if customize else customizations,
+                    ignore_nonstandard_types=False
+                    # Otherwise bibtexparser will complain if I give it a collection
+                )
+                if customize is not None:
+                    bibliography.entries = customize(bibliography.entries)
+                if not args.nodoi:
+                    find_dois(bibliography.entries)
+                output = BibTexWriter().write(bibliography)
+                if args.input:
+                    with replacing(bib) as biblatex:
+                        biblatex.write(output)
+                else:
+                    sys.stdout.write(output)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if cache is not None:
+            cache.close()
+    if timings is not None:
+        print_profile(timings)
+    if args.verbose:
+        # With --jobs the transforms run in the workers, which keep their own
+        print_memo_stats()
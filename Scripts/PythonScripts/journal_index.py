@@ -0,0 +1,571 @@
+#!/usr/bin/env python3
+
+"""A sorted, memory-mapped index of journal names and their abbreviations
+
+The lists in Scripts/journal_abbreviations ('Full Name = Abbrev' lines) are
+compiled once into a binary file. Opening the index maps the file without
+reading it, and each lookup is a binary search, in either direction.
+
+Next to the index is a manifest (JSON) of the format version and the size,
+modification time, and SHA-1 of each list it was built from. `open_index`
+rebuilds the index when a list has changed, or when it was built by another
+version of this module; otherwise opening it only costs a stat of each list.
+
+    python3 journal_index.py --build
+    python3 journal_index.py 'Journal of Philosophy' 'J. Philos.'
+    python3 journal_index.py --fuzzy 'Jornal of Philosophy, Science & Law'
+
+Layout of the index (all integers little-endian, unsigned 32-bit):
+
+    header      magic b'JABR', version, number of journals n
+    records     n x (full offset, full length, abbrev offset, abbrev length),
+                sorted by folded full name
+    by_abbrev   n x record number, sorted by folded abbreviation
+    strings     the names, UTF-8; offsets are from the start of this blob
+"""
+
+import argparse
+import collections
+import contextlib
+import hashlib
+import json
+import math
+import mmap
+import os
+import re
+import stat
+import struct
+import sys
+import tempfile
+
+header = struct.Struct('<4sII')
+record = struct.Struct('<IIII')
+number = struct.Struct('<I')
+magic = b'JABR'
+version = 1
+
+non_word = re.compile(r'\W+')
+
+lists_directory = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    os.pardir,
+    'journal_abbreviations'
+)
+
+# The lists, in the order combineJournalLists.py merges them: when a journal
+# is in more than one, the last one wins. abbreviations.txt is the merge of
+# the other two, so edits made to it take precedence.
+default_sources = [
+    os.path.join(lists_directory, name)
+    for name in ('ncbi.txt', 'jabref.txt', 'abbreviations.txt')
+]
+
+default_path = os.path.join(
+    '~', '.cache', 'convertbibliography', 'journals.idx'
+)
+
+
+def fold(name):
+    """ str -> str
+    Normalize a name for comparison: ignore case and runs of whitespace.
+    >>> fold('Journal  of PHILOSOPHY ')
+    'journal of philosophy'
+    """
+    return ' '.join(name.split()).casefold()
+
+
+def read_lists(sources):
+    """Read journal lists into a dict from folded full names to
+    (full name, abbreviation), later lists overriding earlier ones
+
+    :param sources: paths of files of 'Full Name = Abbrev' lines
+    :returns: -- the dict
+    """
+    journals = {}
+    for source in sources:
+        with open(source, 'r', encoding='utf-8') as f:
+            for line in f:
+                if '=' in line and line[0] != '#':
+                    full, _, abbreviation = line.partition('=')
+                    full = full.strip()
+                    abbreviation = abbreviation.strip()
+                    if full and abbreviation:
+                        journals[fold(full)] = (full, abbreviation)
+    return journals
+
+
+def file_hash(path):
+    """Return the SHA-1 of a file, as hex"""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def source_state(path):
+    """Describe a list as it is now, for the manifest"""
+    stat = os.stat(path)
+    return {
+        'path': os.path.abspath(path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha1': file_hash(path)
+    }
+
+
+# The umask can only be read by setting it
+umask = os.umask(0o022)
+os.umask(umask)
+
+
+@contextlib.contextmanager
+def replacing(path, mode='wb'):
+    """Open a temporary file, which replaces path once it has been written
+
+    Each writer has a temporary file of its own, in the same directory, so
+    processes building the index at the same time don't trip over each
+    other: the last rename wins, and every one of them is a whole file.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, temporary = tempfile.mkstemp(
+        prefix='.' + name + '.', suffix='.tmp', dir=directory
+    )
+    try:
+        encoding = None if 'b' in mode else 'utf-8'
+        with open(fd, mode, encoding=encoding) as f:
+            yield f
+        # mkstemp makes files only the owner can read: keep the permissions
+        # of the file replaced, or give a new one the usual ones
+        try:
+            permissions = stat.S_IMODE(os.stat(path).st_mode)
+        except FileNotFoundError:
+            permissions = 0o666 & ~umask
+        os.chmod(temporary, permissions)
+        os.replace(temporary, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temporary)
+        raise
+
+
+def write_manifest(path, manifest):
+    with replacing(path + '.manifest', 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def is_current(path=default_path, sources=None):
+    """Whether the index at path was built from the lists as they are now
+
+    Lists whose size and modification time are as recorded aren't read.
+    If only the modification time has changed, the list is hashed, and if
+    its contents are the same the manifest is updated rather than the index
+    being rebuilt.
+
+    :param path: the index file
+    :param sources: the lists, by default `default_sources`
+    """
+    sources = default_sources if sources is None else sources
+    path = os.path.expanduser(path)
+    try:
+        with open(path + '.manifest', 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+    states = manifest.get('sources', [])
+    if manifest.get('version') != version or len(states) != len(sources):
+        return False
+    touched = False
+    try:
+        for source, state in zip(sources, states):
+            if state['path'] != os.path.abspath(source):
+                return False
+            stat = os.stat(source)
+            if (stat.st_size, stat.st_mtime_ns) == (
+                state['size'], state['mtime_ns']
+            ):
+                continue
+            if stat.st_size != state['size'] or \
+                    file_hash(source) != state['sha1']:
+                return False
+            state['mtime_ns'] = stat.st_mtime_ns
+            touched = True
+    except (OSError, KeyError):
+        return False
+    if not os.path.exists(path):
+        return False
+    if touched:
+        write_manifest(path, manifest)
+    return True
+
+
+def build(sources=None, path=default_path):
+    """Compile journal lists into an index, and write its manifest
+
+    The index is written to a temporary file and renamed into place, so
+    readers never see a half-written one.
+
+    :param sources: paths of the lists, by default `default_sources`
+    :param path: where to write the index
+    :returns: -- the number of journals in the index
+    """
+    sources = default_sources if sources is None else sources
+    states = [source_state(source) for source in sources]
+    journals = read_lists(sources)
+    keys = sorted(journals)
+    strings = bytearray()
+    offsets = {}
+
+    def add(s):
+        # Many journals share an abbreviation, or are their own
+        if s not in offsets:
+            data = s.encode('utf-8')
+            offsets[s] = (len(strings), len(data))
+            strings.extend(data)
+        return offsets[s]
+
+    records = bytearray()
+    for key in keys:
+        full, abbreviation = journals[key]
+        records.extend(record.pack(*(add(full) + add(abbreviation))))
+    by_abbrev = sorted(
+        range(len(keys)),
+        key=lambda i: (fold(journals[keys[i]][1]), keys[i])
+    )
+    path = os.path.expanduser(path)
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with replacing(path) as f:
+        f.write(header.pack(magic, version, len(keys)))
+        f.write(records)
+        f.write(b''.join(number.pack(i) for i in by_abbrev))
+        f.write(strings)
+    write_manifest(path, {'version': version, 'sources': states})
+    return len(keys)
+
+
+class JournalIndex(object):
+    """Look up journal abbreviations in an index made by `build`
+
+    :param path: the index file
+    """
+
+    def __init__(self, path=default_path):
+        self.path = os.path.expanduser(path)
+        with open(self.path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        found, found_version, self.size = header.unpack_from(self.map, 0)
+        if found != magic or found_version != version:
+            self.map.close()
+            raise ValueError(
+                "{} isn't a version {} journal index.".format(path, version)
+            )
+        self.records = header.size
+        self.by_abbrev = self.records + record.size * self.size
+        self.strings = self.by_abbrev + number.size * self.size
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        """Yield each (full name, abbreviation), in order of full name"""
+        for i in range(self.size):
+            yield self._record(i)
+
+    def close(self):
+        self.map.close()
+
+    def _string(self, offset, length):
+        start = self.strings + offset
+        return self.map[start:start + length].decode('utf-8')
+
+    def _record(self, i):
+        """Return the (full name, abbreviation) of the i-th record"""
+        full_offset, full_length, abbrev_offset, abbrev_length =\
+            record.unpack_from(self.map, self.records + record.size * i)
+        return (
+            self._string(full_offset, full_length),
+            self._string(abbrev_offset, abbrev_length)
+        )
+
+    def _by_abbrev(self, i):
+        return number.unpack_from(self.map, self.by_abbrev + number.size * i)[0]
+
+    def _search(self, key, position, field):
+        """Return the record with the folded `field` equal to `key`, if any
+
+        :param key: a folded name
+        :param position: maps a position in the order being searched to a
+            record number
+        :param field: 0 to search full names, 1 abbreviations
+        """
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if fold(self._record(position(middle))[field]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.size:
+            found = self._record(position(low))
+            if fold(found[field]) == key:
+                return found
+        return None
+
+    def abbreviate(self, name):
+        """ str -> str or None
+        Return the abbreviation of a journal's full name.
+        """
+        found = self._search(fold(name), lambda i: i, 0)
+        return found[1] if found else None
+
+    def expand(self, abbreviation):
+        """ str -> str or None
+        Return the full name of a journal from its abbreviation.
+        Where journals share an abbreviation, the first name in
+        alphabetical order is given.
+        """
+        found = self._search(fold(abbreviation), self._by_abbrev, 1)
+        return found[0] if found else None
+
+
+def simplify(name):
+    """ str -> str
+    Normalize a name for matching: ignore case and punctuation.
+    >>> simplify('J. Phil. & Sci.')
+    'j phil sci'
+    """
+    return ' '.join(non_word.sub(' ', name).split()).casefold()
+
+
+def trigrams(name):
+    """ str -> set
+    Return the three letter pieces of a name, ignoring case and punctuation.
+    >>> sorted(trigrams('J. Phil.'))
+    ['  j', ' j ', ' ph', 'hil', 'il ', 'j p', 'phi']
+    """
+    padded = '  ' + simplify(name) + ' '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class JournalMatcher(object):
+    """Find the journal a misspelled or variant title is most likely to be
+
+    Every full name and abbreviation in the lists is split into trigrams,
+    and each trigram is indexed to the names it occurs in. A title is
+    matched to the name with the highest Dice similarity of trigrams,
+    2|A & B| / (|A| + |B|), if that is at least `threshold`. Only names
+    which share one of the title's rarest trigrams can reach the threshold,
+    so only those are compared.
+
+    :param journals: a dict like the one `read_lists` returns
+    :param threshold: the least similarity (0 to 1) which counts as a match
+    """
+
+    def __init__(self, journals, threshold=0.8):
+        self.threshold = threshold
+        # Names which are matched against, and their full names
+        self.names = []
+        self.full_names = []
+        self.sizes = []
+        self.postings = collections.defaultdict(set)
+        self.exact = {}
+        for key in sorted(journals):
+            full, abbreviation = journals[key]
+            for name in (full, abbreviation):
+                simple = simplify(name)
+                if simple in self.exact:
+                    continue
+                self.exact[simple] = full
+                number = len(self.names)
+                self.names.append(name)
+                self.full_names.append(full)
+                grams = trigrams(name)
+                self.sizes.append(len(grams))
+                for gram in grams:
+                    self.postings[gram].add(number)
+        self.postings = dict(self.postings)
+
+    @classmethod
+    def from_index(cls, index, threshold=0.8):
+        """Build a matcher from the journals in a JournalIndex"""
+        return cls(
+            {fold(full): (full, abbreviation) for full, abbreviation in index},
+            threshold
+        )
+
+    @classmethod
+    def from_lists(cls, sources=None, threshold=0.8):
+        """Build a matcher from journal lists, by default `default_sources`"""
+        return cls(
+            read_lists(default_sources if sources is None else sources),
+            threshold
+        )
+
+    def match(self, title, threshold=None):
+        """ str -> (str, float) or None
+        Return the full name of the journal most like `title`,
+        and how similar they are; None if nothing is similar enough.
+        """
+        threshold = self.threshold if threshold is None else threshold
+        simple = simplify(title)
+        if simple in self.exact:
+            return self.exact[simple], 1.0
+        grams = trigrams(title)
+        if not grams or threshold <= 0:
+            return None
+        # Dice >= t needs at least t|A| / (2 - t) trigrams in common,
+        # so a match must have one of the rarest of the title's trigrams,
+        # and can't be too much shorter or longer than the title
+        size = len(grams)
+        needed = max(math.ceil(threshold * size / (2 - threshold)), 1)
+        shortest = needed
+        longest = size * (2 - threshold) / threshold
+        known = sorted(
+            (gram for gram in grams if gram in self.postings),
+            key=lambda gram: len(self.postings[gram])
+        )
+        if len(known) < needed:
+            return None
+        prefix = len(known) - needed + 1
+        counts = collections.Counter()
+        for gram in known[:prefix]:
+            counts.update(self.postings[gram])
+        rest = [self.postings[gram] for gram in known[prefix:]]
+        # Names grouped by how many of the rarest trigrams they have
+        levels = collections.defaultdict(list)
+        for candidate, common in counts.items():
+            if shortest <= self.sizes[candidate] <= longest:
+                levels[common].append(candidate)
+        best = None
+        best_score = threshold
+        for common in sorted(levels, reverse=True):
+            # No name with fewer in common can do as well as the best
+            if common + len(rest) < best_score * (size + shortest) / 2:
+                break
+            for candidate in levels[common]:
+                other = self.sizes[candidate]
+                if common + len(rest) < best_score * (size + other) / 2:
+                    continue
+                score = 2 * (
+                    common + sum(1 for posting in rest if candidate in posting)
+                ) / (size + other)
+                if score > best_score or (
+                    score == best_score and (best is None or candidate < best)
+                ):
+                    # Of names which tie, the earliest is kept
+                    best, best_score = candidate, score
+        if best is None:
+            return None
+        return self.full_names[best], best_score
+
+    def normalize(self, title, threshold=None):
+        """ str -> str
+        Return the full name of the journal most like `title`, or `title`
+        itself if there's none similar enough.
+        """
+        found = self.match(title, threshold)
+        return found[0] if found else title
+
+    def normalize_records(self, records, field='journaltitle', threshold=None):
+        """Replace `field` of each record with the journal's full name
+
+        Each distinct title is only matched once.
+
+        :param records: a list of records, e.g. bibliography.entries
+        :param field: the field holding the journal's name
+        :param threshold: the least similarity which counts as a match
+        :returns: -- the number of records which were changed
+        """
+        matched = {}
+        changed = 0
+        for record in records:
+            if field not in record:
+                continue
+            title = record[field]
+            if title not in matched:
+                matched[title] = self.normalize(title, threshold)
+            if matched[title] != title:
+                record[field] = matched[title]
+                changed += 1
+        return changed
+
+
+def open_index(path=default_path, sources=None):
+    """Open the index at path, building it first if there isn't one or the
+    lists have changed since it was built
+
+    :param path: the index file
+    :param sources: the lists to build it from, by default `default_sources`
+    :returns: -- a JournalIndex
+    """
+    if not is_current(path, sources):
+        try:
+            build(sources, path)
+        except OSError:
+            # Another process may have built it in the meantime
+            if not is_current(path, sources):
+                raise
+    return JournalIndex(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'names',
+        nargs='*',
+        help='Full names to abbreviate, or abbreviations to expand'
+    )
+    parser.add_argument(
+        '--index',
+        default=default_path,
+        help='The index file (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--build',
+        action='store_true',
+        help='(Re)build the index from the lists'
+    )
+    parser.add_argument(
+        '--sources',
+        nargs='+',
+        help='The lists to build the index from, last one winning'
+    )
+    parser.add_argument(
+        '--fuzzy',
+        action='store_true',
+        help='Find the journals most like the names given'
+    )
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.8,
+        help='The least similarity (0 to 1) --fuzzy counts as a match'
+    )
+    args = parser.parse_args()
+    if args.fuzzy:
+        matcher = JournalMatcher.from_index(
+            open_index(args.index, args.sources), args.threshold
+        )
+        for name in args.names:
+            found = matcher.match(name)
+            if found is not None:
+                print('{} = {} ({:.2f})'.format(name, *found))
+            else:
+                print("I couldn't find {}.".format(name), file=sys.stderr)
+        sys.exit()
+    if args.build:
+        print('{} journals'.format(build(args.sources, args.index)))
+    index = open_index(args.index, args.sources)
+    for name in args.names:
+        abbreviation = index.abbreviate(name)
+        if abbreviation is not None:
+            print('{} = {}'.format(name, abbreviation))
+            continue
+        full = index.expand(name)
+        if full is not None:
+            print('{} = {}'.format(full, name))
+        else:
+            print("I couldn't find {}.".format(name), file=sys.stderr)
+    index.close()
@@ -6,6 +6,8 @@
 
 import urllib
 import urllib2
+import httplib
+import socket
 import re
 import os
 import logging
@@ -13,11 +15,20 @@ import argparse
 import translitcodec
 import anyjson
 import hashlib
-import subdist
+import math
 import glob
 import cookielib
 import subprocess
 import datetime
+import sys
+import zlib
+import time
+import threading
+import Queue
+import urlparse
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 #logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S', filename=os.path.join(os.path.expanduser('~'), '/tmp/.pdfmeatfile.log'))
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S', filename=os.path.join(os.path.expanduser('~'), '/tmp/.pdfmeatfile.log'))
@@ -31,6 +42,11 @@ GA_URL = 'http://ajax.googleapis.com/ajax/services/search/web?v=1.0&%s&key=ABQIA
 
 GS_TRIES=3
 GA_TRIES=2
+QUERYWORDSOFFSET=64
+# a title may be this much (edit distance by length) off the head of the pdf
+MATCH_THRESHOLD=0.1
+# queries in flight at once when all are sent up front (0: one after another)
+SPECULATE=0
 
 REGS = dict()
 REGS['none'] = "did not match any articles|Sorry, no information is available for"
@@ -38,9 +54,552 @@ REGS['one'] = 'Showing web page information for'
 REGS['some'] = ">([0-9,]+) result"
 REGS['sorry'] = "We're sorry|please type the characters"
 
+# what setFragments looks for in the text of the pdf
+FRAGMENTS = dict()
+FRAGMENTS['head'] = re.compile(r"(.*?)((abstract)|(introduction))\n", re.I|re.S)
+FRAGMENTS['abstract'] = re.compile(r'(?:(?i)Abstract)[:\. \n]+([A-Z].{99,3333})(\n[0-9 \.]*(?:(?i)Introduction))', re.S)
+FRAGMENTS['doi'] = re.compile(r'DOI (\d\d\.\d\d\d\d/\w[^ \n]+)', re.I | re.S)
+
+# scholar result pages, see scholar_entries
+SCHOLAR = dict()
+SCHOLAR['hit'] = re.compile('(<h3 class="gs_rt">(.*?)</div></div>)', re.DOTALL)
+SCHOLAR['bold'] = re.compile('</?b>')
+# what is left to clean up, in one pass: [PDF] and such, spaces, entities
+SCHOLAR['clean'] = re.compile('<font .*?>\[[^\]]+\]</font>|&nbsp;|<br>|&hellip;|&amp;')
+SCHOLAR['cleaned'] = {'&hellip;': '...', '&amp;': '&'}
+SCHOLAR['title'] = re.compile('<h3.*?>.*?(?:<span .*?</span> )?((<a href="([^"]+)"[^>]*>)?([^<]+)(</a>)?)</h3>')
+SCHOLAR['citations'] = re.compile('>Cited by ([0-9]+)<')
+SCHOLAR['citedby'] = re.compile(' href="/scholar\?([^"]*cites=([0-9]+))')
+SCHOLAR['authorvenueyear'] = re.compile('<div class="gs_a">(.*?)</div>')
+SCHOLAR['avy'] = re.compile('^(.*?)( - ((?:(.*?), ((?:19|20)[0-9][0-9])|(((?:19|20)[0-9][0-9])|(.*?)))))? - (.*)$')
+SCHOLAR['tag'] = re.compile('<[^<]+?>')
+SCHOLAR['year'] = re.compile('(19|20)[0-9][0-9]')
+SCHOLAR['cache'] = re.compile('q=cache:([^+"]+)[^"]*">View as HTML</a>')
+SCHOLAR['import'] = re.compile('href="/scholar\.([^"]+)".*?>Import into .*?</a>')
+
+def scholar_entries(content):
+    """the entries of a scholar result page, one by one as they are asked for:
+    dicts of title and url, and of authors, venue, year, publisher, citations,
+    citedbyid, htmllink and importlink as far as found"""
+    for m in SCHOLAR['hit'].finditer(content):
+        a = SCHOLAR['bold'].sub('', m.group(1))
+        a = SCHOLAR['clean'].sub(lambda c: SCHOLAR['cleaned'].get(c.group(0), ''), a) # 2010-02-22: &amp;
+        m1 = SCHOLAR['title'].search(a)
+        if m1 is None:
+            continue
+        myItem = {}
+        myItem['url'] = m1.group(3)
+        myItem['title'] = m1.group(4) #.strip()
+
+        m2 = SCHOLAR['citations'].search(a)
+        if m2 != None:
+            myItem['citations'] = m2.group(1)
+        m_pcl = SCHOLAR['citedby'].search(a)
+        if m_pcl != None:
+            myItem['citedbyid'] = m_pcl.group(2)
+        m3 = SCHOLAR['authorvenueyear'].search(a)
+        if m3 != None:
+            m4 = SCHOLAR['avy'].search(m3.group(1))
+            if m4 != None:
+                myItem['authors'] = SCHOLAR['tag'].sub('', m4.group(1))
+                if m4.group(4) != None:
+                    myItem['venue'] = m4.group(4)
+                for g in (5, 6, 7):
+                    if m4.group(g) != None and SCHOLAR['year'].match(m4.group(g)):
+                        myItem['year'] = m4.group(g)
+                if m4.group(8) != None:
+                    myItem['venue'] = m4.group(8)
+                if m4.group(9) != None:
+                    myItem['publisher'] = m4.group(9)
+        m_pca = SCHOLAR['cache'].search(a)
+        if m_pca != None:
+            myItem['htmllink'] = 'http://scholar.google.com/scholar?q=cache:' + m_pca.group(1)
+        m_pim = SCHOLAR['import'].search(a)
+        if m_pim != None:
+            myItem['importlink'] = 'http://scholar.google.com/scholar.' + m_pim.group(1)
+        # querylink = "http://scholar.google.com/scholar?q=" + urllib.quote("intitle:\"" + title + "\"")
+        yield myItem
+
+# pages of text extracted: more only when the fragments are not found yet
+PAGE_STEPS = (1, 3, 10)
+
+# every request goes through the session of the process, see web()
+SESSION = None
+SESSION_LOCK = threading.Lock()
+TIMEOUT = 30
+RETRIES = 3
+BACKOFF = 10.0
+# results by md5 of the pdf (or doi/title), set up by main()
+CACHE = None
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'pdfmeat', 'results.sqlite')
+
+class ResultCache:
+    """sqlite store of found entries: text fragments, the matched scholar
+    entry and the fetched bibtex, keyed by 'md5:...', 'doi:...' or 'title:...'.
+    Safe to share between the threads of a batch run."""
+
+    def __init__(self, path=CACHE_PATH):
+        import sqlite3
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.path = path
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.con.execute('create table if not exists results (key text primary key, result text, stored real)')
+        self.con.execute('create table if not exists texts (key text primary key, text blob, pages integer, complete integer)')
+        self.con.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            row = self.con.execute('select result from results where key = ?', (key,)).fetchone()
+        finally:
+            self.lock.release()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return anyjson.deserialize(row[0])
+
+    def put(self, key, result):
+        self.lock.acquire()
+        try:
+            self.con.execute('insert or replace into results values (?, ?, ?)', (key, anyjson.serialize(result), time.time()))
+            self.con.commit()
+        finally:
+            self.lock.release()
+
+    def getText(self, key):
+        """(text, pages, complete) extracted from the pdf, or None"""
+        self.lock.acquire()
+        try:
+            row = self.con.execute('select text, pages, complete from texts where key = ?', (key,)).fetchone()
+        finally:
+            self.lock.release()
+        if row is None:
+            return None
+        return str(row[0]), row[1], bool(row[2])
+
+    def putText(self, key, text, pages, complete):
+        import sqlite3
+        self.lock.acquire()
+        try:
+            self.con.execute('insert or replace into texts values (?, ?, ?, ?)', (key, sqlite3.Binary(text), pages, int(complete)))
+            self.con.commit()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.con.close()
+
+class HostRateLimiter:
+    """Keep requests to the same host at least `interval` seconds apart.
+    Shared by the lookup threads of a batch run."""
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_slot = dict()
+
+    def wait(self, url):
+        host = urlparse.urlparse(url).netloc
+        self.lock.acquire()
+        try:
+            now = time.time()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        finally:
+            self.lock.release()
+        if slot > now:
+            time.sleep(slot - now)
+
+# file hashes: the digest names the bibtex field and prefixes the cache key
+# md5 is what older entries have; crc32 (with the size) is quicker on big scans
+HASHES = {
+    'md5': ('md5sum', lambda data: hashlib.md5(data).hexdigest()),
+    'crc32': ('crc32', lambda data: '%d-%08x' % (len(data), zlib.crc32(data) & 0xffffffff)),
+}
+HASH = 'md5'
+
 class WebScrapingError(Exception):
     pass
 
+class QueryCancelled(Exception):
+    """a speculative query not sent, as another one matched already"""
+    pass
+
+class ResponseInfo:
+    """what cookielib needs of a response to take the cookies it sets"""
+
+    def __init__(self, response):
+        self.response = response
+
+    def info(self):
+        return self.response.msg
+
+class WebSession:
+    """One per process (see web()): keeps a connection open to each host,
+    loads the firefox cookies once, paces requests by host, and backs off
+    when scholar answers with a captcha. httplib connections are not
+    thread-safe, so each thread has its own."""
+
+    useragent = 'Mozilla/5.0 (X11; Linux x86_64; rv:6.0) Gecko/20100101 Firefox/6.0'
+    referer = 'http://scholar.google.com'
+
+    def __init__(self, interval=1.0, timeout=TIMEOUT, retries=RETRIES, backoff=BACKOFF):
+        self.limiter = HostRateLimiter(interval)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pid = os.getpid()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.jar = None
+        self.requests = 0
+        self.reuses = 0
+        self.retried = 0
+
+    def cookies(self, refresh=False):
+        self.lock.acquire()
+        try:
+            if self.jar is None:
+                self.jar = firefox_cookie()
+            elif refresh:
+                try:
+                    self.jar = firefox_cookie(refresh=True)
+                except WebScrapingError, err:
+                    logging.warning("keeping the cookies: %s" % err)
+            return self.jar
+        finally:
+            self.lock.release()
+
+    def count(self, requests=0, reuses=0, retried=0):
+        self.lock.acquire()
+        try:
+            self.requests += requests
+            self.reuses += reuses
+            self.retried += retried
+        finally:
+            self.lock.release()
+
+    def connection(self, scheme, host):
+        """(connection, reused): the open connection of this thread to host"""
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = dict()
+        conn = self.local.connections.get((scheme, host))
+        if conn is not None:
+            return conn, True
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(host, timeout=self.timeout)
+        self.local.connections[(scheme, host)] = conn
+        return conn, False
+
+    def drop(self, scheme, host):
+        conn = self.local.connections.pop((scheme, host), None)
+        if conn is not None:
+            conn.close()
+
+    def fetch(self, url, redirects=5, cancel=None):
+        """body of url, following redirects; raises QueryCancelled if the
+        threading.Event cancel is set by the time the request can be sent"""
+        for _ in range(redirects + 1):
+            self.limiter.wait(url)
+            if cancel is not None and cancel.is_set():
+                raise QueryCancelled(url)
+            parts = urlparse.urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            req = urllib2.Request(url, headers={'User-agent': self.useragent, 'Referer': self.referer})
+            jar = self.cookies()
+            jar.add_cookie_header(req)
+            for attempt in range(2):
+                conn, reused = self.connection(parts.scheme, parts.netloc)
+                try:
+                    conn.request('GET', path, headers=dict(req.header_items()))
+                    resp = conn.getresponse()
+                    body = resp.read()
+                    break
+                except (httplib.HTTPException, socket.error), err:
+                    self.drop(parts.scheme, parts.netloc)
+                    # a kept-alive connection the server has since closed: once more on a new one
+                    if not reused or attempt > 0:
+                        raise urllib2.URLError(err)
+                    logging.debug("reconnecting to %s: %s" % (parts.netloc, err))
+                    self.count(retried=1)
+            self.count(requests=1, reuses=int(reused))
+            jar.extract_cookies(ResponseInfo(resp), req)
+            if resp.will_close:
+                self.drop(parts.scheme, parts.netloc)
+            location = resp.getheader('location')
+            if resp.status in (301, 302, 303, 307) and location:
+                url = urlparse.urljoin(url, location)
+                continue
+            # scholar serves its captcha with 429 or 503: get() backs off on it
+            if resp.status >= 400 and not (resp.status in (429, 503) and re.search(REGS['sorry'], body)):
+                raise urllib2.HTTPError(url, resp.status, resp.reason, resp.msg, None)
+            return body
+        raise urllib2.URLError('too many redirects: %s' % url)
+
+    def get(self, url, cancel=None):
+        """text of url; on a captcha, waits backoff, 2*backoff, ... seconds and
+        tries again with the cookies firefox has then (solved in the browser?)"""
+        for attempt in range(self.retries + 1):
+            html = self.fetch(url, cancel=cancel).decode('utf8')
+            if not re.search(REGS['sorry'], html):
+                break
+            logging.critical("scholar captcha")
+            logging.debug(html)
+            if attempt == 0:
+                import webbrowser
+                webbrowser.get().open_new_tab(url)
+            if attempt < self.retries:
+                delay = self.backoff * 2 ** attempt
+                logging.info("captcha: trying again in %.0fs" % delay)
+                time.sleep(delay)
+                self.count(retried=1)
+                self.cookies(refresh=True)
+        return html
+
+    def stats(self):
+        return "requests: %d, on kept-alive connections: %d, retries: %d" % (self.requests, self.reuses, self.retried)
+
+def web():
+    """the WebSession of this process"""
+    global SESSION
+    SESSION_LOCK.acquire()
+    try:
+        if SESSION is None or SESSION.pid != os.getpid():
+            SESSION = WebSession()
+        return SESSION
+    finally:
+        SESSION_LOCK.release()
+
+# adapted from http://code.google.com/p/webscraping/source/browse/common.py
+def firefox_cookie(filename=None, tmp_sqlite_file='/tmp/.pdfmeat_cookies.sqlite', tmp_cookie_file='/tmp/.pdfmeat_cookies.txt', refresh=False):
+    """Create a cookie jar from this FireFox 3 sqlite cookie database;
+    refresh to read the database again rather than the copy made of it
+
+    >>> cj = firefox_cookie()
+    >>> opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cj))
+    >>> url = 'http://code.google.com/p/webscraping'
+    >>> html = opener.open(url).read()
+    """
+
+    if refresh or not os.path.exists(tmp_cookie_file):
+        
+        if filename is None:
+            try:
+                filename = glob.glob(os.path.expanduser('~/Library/Application Support/Firefox/Profiles/*.default/cookies.sqlite'))[0]
+                
+            except IndexError:
+                raise WebScrapingError('Cannot find firefox cookie database')
+
+        # copy firefox cookie file locally to avoid locking problems
+        import shutil
+        shutil.copyfile(filename, tmp_sqlite_file)
+        import sqlite3             
+        con = sqlite3.connect(tmp_sqlite_file)
+        cur = con.cursor()
+        cur.execute('select host, path, isSecure, expiry, name, value from moz_cookies')
+
+        # create standard cookies file that can be interpreted by cookie jar 
+        fp = open(tmp_cookie_file, 'w')
+        fp.write('# Netscape HTTP Cookie File\n')
+        fp.write('# http://www.netscape.com/newsref/std/cookie_spec.html\n')
+        fp.write('# This is a generated file!  Do not edit.\n')
+        ftstr = ['FALSE', 'TRUE']
+        for item in cur.fetchall():
+            row = '%s\t%s\t%s\t%s\t%s\t%s\t%s\n' % (item[0], ftstr[item[0].startswith('.')], item[1], ftstr[item[2]], item[3], item[4], item[5])
+            fp.write(row)
+        fp.close()
+
+    cookie_jar = cookielib.MozillaCookieJar()
+    cookie_jar.load(tmp_cookie_file)
+    return cookie_jar
+
+def substring_distance(pattern, text, k):
+    """Least edit distance between pattern and any substring of text, if it
+    is at most k (else None). Ukkonen's cutoff: of each column only the rows
+    still within k are computed, and k comes down with each closer match.
+
+    >>> substring_distance('meat', 'pdf metadata', 1)
+    1
+    >>> substring_distance('meat', 'pdf metadata', 0) is None
+    True
+    """
+    m = len(pattern)
+    k = min(k, m - 1)
+    if k < 0:
+        return None
+    C = range(m + 1)
+    lact = k # last row within k
+    best = None
+    for t in text:
+        # a row is never less than the one diagonally above it: rows past
+        # lact + 1 are still above k
+        if lact < m:
+            lact += 1
+        pC = nC = 0
+        for i in xrange(1, lact + 1):
+            if pattern[i - 1] == t:
+                nC = pC
+            else:
+                if C[i] < nC:
+                    nC = C[i]
+                if pC < nC:
+                    nC = pC
+                nC += 1
+            pC = C[i]
+            C[i] = nC
+        if lact == m and C[m] <= k:
+            best = C[m]
+            if best == 0:
+                return 0
+            k = best - 1
+        while C[lact] > k:
+            lact -= 1
+    return best
+
+class TitleMatcher:
+    """Scores normalized titles against the normalized head of a pdf: by
+    substring, else by substring_distance. A title which shares too few of
+    its trigrams with the head to be within k is passed over at once."""
+
+    q = 3
+
+    def __init__(self, head):
+        self.head = head
+        self.grams = set(head[i:i + self.q] for i in xrange(len(head) - self.q + 1))
+
+    def distance(self, title, k):
+        if title in self.head:
+            return 0
+        # each edit spoils at most q of the trigrams of the title
+        needed = len(title) - self.q + 1 - k * self.q
+        if needed > 0:
+            shared = 0
+            for i in xrange(len(title) - self.q + 1):
+                if title[i:i + self.q] in self.grams:
+                    shared += 1
+            if shared < needed:
+                return None
+        return substring_distance(title, self.head, k)
+
+    def best(self, titles, threshold=MATCH_THRESHOLD):
+        """(index, distance) of the title least off the head, by distance
+        over length, if that is below threshold; else (None, None)"""
+        found, distance, ratio = None, None, threshold
+        for i, title in enumerate(titles):
+            if not title:
+                continue
+            # a distance of k or less is below ratio
+            k = int(math.ceil(ratio * len(title))) - 1
+            d = self.distance(title, k)
+            if d is not None:
+                found, distance, ratio = i, d, float(d) / len(title)
+                if d == 0:
+                    break
+        return found, distance
+
+class BibtexEntry:
+    """The first entry of a bibtex string, parsed once into its fields, which
+    can be set (and replaced) and are written out again in one go. If the
+    string cannot be parsed, the fields set are added after the first line
+    ending in a brace, as they were before entries were parsed.
+
+    >>> b = BibtexEntry(u'@article{doe2000,\\n  title={A Study},\\n  year={2000}\\n}\\n')
+    >>> b['doi'] = '10.1000/1'
+    >>> print b.serialize()
+    @article{doe2000,
+      title={A Study},
+      year={2000},
+      doi={10.1000/1}
+    }
+    <BLANKLINE>
+    >>> b = BibtexEntry(u'@article{doe2000,\\n  title={A {Study}\\n}\\n')
+    >>> b.fields is None
+    True
+    >>> b['doi'] = '10.1000/1'
+    >>> print b.serialize()
+    @article{doe2000,
+      title={A {Study},
+      doi={10.1000/1}
+    }
+    <BLANKLINE>
+    """
+
+    head = re.compile(r'\s*@(\w+)\s*\{\s*([^,\s]*)\s*,')
+    name = re.compile(r'\s*([^=\s,{}]+)\s*=\s*')
+    bare = re.compile(r'[^,}\s]+')
+    separator = re.compile(r'\s*(,?)\s*')
+
+    def __init__(self, bibtex):
+        self.bibtex = bibtex
+        self.fields = None
+        self.appended = []
+        m = self.head.match(bibtex)
+        if m is None:
+            return
+        self.start, self.entrytype, self.key = bibtex[:m.start(1) - 1], m.group(1), m.group(2)
+        fields = collections.OrderedDict()
+        pos = m.end()
+        while True:
+            pos = self.separator.match(bibtex, pos).end()
+            if bibtex.startswith('}', pos):
+                break
+            m = self.name.match(bibtex, pos)
+            if m is None:
+                return
+            value_end = self.valueEnd(bibtex, m.end())
+            if value_end is None:
+                return
+            fields[m.group(1)] = bibtex[m.end():value_end]
+            pos = value_end
+        self.fields = fields
+        self.rest = bibtex[pos + 1:]
+
+    def valueEnd(self, bibtex, pos):
+        """where the value at pos ends: {braced}, "quoted" or bare"""
+        if bibtex.startswith('{', pos) or bibtex.startswith('"', pos):
+            depth = 0
+            for i in xrange(pos, len(bibtex)):
+                c = bibtex[i]
+                if c == '{':
+                    depth += 1
+                elif c == '}':
+                    depth -= 1
+                    if depth == 0 and bibtex[pos] == '{':
+                        return i + 1
+                elif c == '"' and depth == 0 and i > pos:
+                    return i + 1
+            return None
+        m = self.bare.match(bibtex, pos)
+        return m.end() if m is not None else None
+
+    def __setitem__(self, name, value):
+        if self.fields is not None:
+            self.fields[name] = '{' + value + '}'
+        else:
+            self.appended.append((name, value))
+
+    def __contains__(self, name):
+        return self.fields is not None and name in self.fields
+
+    def serialize(self):
+        if self.fields is None:
+            end = self.bibtex.find('}\n') + 1
+            if end == 0:
+                return self.bibtex
+            appended = ''.join(',\n  %s={%s}' % field for field in self.appended)
+            return self.bibtex[:end] + appended + self.bibtex[end:]
+        lines = ['  %s=%s' % field for field in self.fields.iteritems()]
+        return '%s@%s{%s,\n%s\n}%s' % (self.start, self.entrytype, self.key, ',\n'.join(lines), self.rest)
+
 class PdfMeatFile:
 
     def __init__(self, filename = None, doi=None, title=None):
@@ -49,6 +608,7 @@ class PdfMeatFile:
         self.title = title
         
         self.queryLog = []
+        self.headMatcher = None
         self.queryNo = 0
         self.gs_hits = None
         self.bibtex = None
@@ -64,6 +624,14 @@ class PdfMeatFile:
         self.newfilename = self.oldfilename
 
         self.md5sum = None
+        self.hashname = None
+        self.hashsum = None
+
+        self.rawtext = None
+        self.pages = 0
+        self.complete = True # until extractText
+        self.textOptions = None
+        self.pdfdata = None
 
     def __repr__(self):
         if self.bibtex is not None and len(self.bibtex) > 0:
@@ -78,15 +646,30 @@ class PdfMeatFile:
                 pass
         return str
 
-    def pdfToText(self, options = None):
+    def pdfToText(self, options = None, data = None, first = 1, last = 10):
+        """text of pages first to last; with data (the bytes of the pdf),
+        pdftotext reads them from stdin instead of reading the file again.
+        Past the last page, pdftotext fails: the text is then empty."""
        
-        commando_pdf2txt = ["pdftotext", '-q', '-f', '1', '-l', '10']
+        commando_pdf2txt = ["pdftotext", '-q', '-f', str(first), '-l', str(last)]
         if options is not None:
             commando_pdf2txt.extend(options)
-        commando_pdf2txt.append(self.filename)            
+        if data is not None:
+            commando_pdf2txt.append('fd://0') # poppler: read from stdin
+        else:
+            commando_pdf2txt.append(self.filename)            
         commando_pdf2txt.append('-')
-        proc = subprocess.Popen(commando_pdf2txt, stdout=subprocess.PIPE)
-        c_txt = proc.communicate()[0]
+        if data is not None:
+            proc = subprocess.Popen(commando_pdf2txt, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            c_txt = proc.communicate(data)[0]
+            # from page 1, a failure is not a page range after the end
+            if proc.returncode != 0 and not c_txt and first == 1:
+                logging.debug("pdftotext: cannot read stdin, reading %s" % self.filename)
+                self.pdfdata = None # for the pages after, too
+                return self.pdfToText(options, None, first, last)
+        else:
+            proc = subprocess.Popen(commando_pdf2txt, stdout=subprocess.PIPE)
+            c_txt = proc.communicate()[0]
 
         if c_txt is None:
             logging.error("pdftotext: empty")
@@ -96,28 +679,13 @@ class PdfMeatFile:
 
         return c_txt #[0:9999]
     
-    def getWebdata(self, url):
-        useragent = 'Mozilla/5.0 (X11; Linux x86_64; rv:6.0) Gecko/20100101 Firefox/6.0'
-        referer = 'http://scholar.google.com'
-    
-        cj = self.firefox_cookie()
-        opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cj))
-        opener.addheaders = [('User-agent', useragent), ('Referer', referer)]
-        html = opener.open(url).read() # use current firefox cookies to access url
-        
-        html = html.decode('utf8')
+    def getWebdata(self, url, cancel=None, browse=True):
+        """html of url; browse=False leaves opening the browser on no
+        results (FAILTOBROWSER) to the caller"""
+        html = web().get(url, cancel) # with the current firefox cookies
         #html = html.encode('translit/long')        
         
-        #if re.search(r"We're sorry", html) or re.search("please type the characters", html):
-        if re.search(REGS['sorry'], html):
-            logging.critical("scholar captcha")
-            logging.debug(html)
-            import webbrowser
-            webbrowser.get().open_new_tab(url)
-            os.remove('/tmp/.pdfmeat_cookies.sqlite')
-            os.remove('/tmp/.pdfmeat_cookies.txt')
-        
-        if FAILTOBROWSER is True and re.search(REGS['none'], html):
+        if browse and FAILTOBROWSER is True and re.search(REGS['none'], html):
             import webbrowser
             webbrowser.get().open_new_tab(url)
         
@@ -126,48 +694,6 @@ class PdfMeatFile:
             webbrowser.get().open_new_tab(url)
     
         return html
-    
-    # adapted from http://code.google.com/p/webscraping/source/browse/common.py
-    def firefox_cookie(self, filename=None, tmp_sqlite_file='/tmp/.pdfmeat_cookies.sqlite', tmp_cookie_file='/tmp/.pdfmeat_cookies.txt'):
-        """Create a cookie jar from this FireFox 3 sqlite cookie database
-    
-        >>> cj = firefox_cookie()
-        >>> opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cj))
-        >>> url = 'http://code.google.com/p/webscraping'
-        >>> html = opener.open(url).read()
-        """
-    
-        if not os.path.exists(tmp_cookie_file):
-            
-            if filename is None:
-                try:
-                    filename = glob.glob(os.path.expanduser('~/Library/Application Support/Firefox/Profiles/*.default/cookies.sqlite'))[0]
-                    
-                except IndexError:
-                    raise WebScrapingError('Cannot find firefox cookie database')
-    
-            # copy firefox cookie file locally to avoid locking problems
-            import shutil
-            shutil.copyfile(filename, tmp_sqlite_file)
-            import sqlite3             
-            con = sqlite3.connect(tmp_sqlite_file)
-            cur = con.cursor()
-            cur.execute('select host, path, isSecure, expiry, name, value from moz_cookies')
-    
-            # create standard cookies file that can be interpreted by cookie jar 
-            fp = open(tmp_cookie_file, 'w')
-            fp.write('# Netscape HTTP Cookie File\n')
-            fp.write('# http://www.netscape.com/newsref/std/cookie_spec.html\n')
-            fp.write('# This is a generated file!  Do not edit.\n')
-            ftstr = ['FALSE', 'TRUE']
-            for item in cur.fetchall():
-                row = '%s\t%s\t%s\t%s\t%s\t%s\t%s\n' % (item[0], ftstr[item[0].startswith('.')], item[1], ftstr[item[2]], item[3], item[4], item[5])
-                fp.write(row)
-            fp.close()
-    
-        cookie_jar = cookielib.MozillaCookieJar()
-        cookie_jar.load(tmp_cookie_file)
-        return cookie_jar
 
     def unescape(self, text):
         def fixup(m):
@@ -205,30 +731,36 @@ class PdfMeatFile:
         return t
 
 
-    def matchScholarEntries(self, p_head, entries):
-        pn = self.normalizeTitle(p_head)
-        eNo = 0
-        for e in entries:
-            eNo+=1
-            t = e['title']
-            tn = self.normalizeTitle(t)
-            # test whether title contained in pdftext
-            logging.debug("normalized title to match: %s" % tn)
-            self.queryLog.append("normalized title to match: %s" % tn)
+    def titleMatcher(self, p_head):
+        """the TitleMatcher for p_head, normalized once for all the queries"""
+        matcher = self.headMatcher
+        if matcher is None or matcher[0] != p_head:
+            pn = self.normalizeTitle(p_head)
             logging.debug("p_head: %s" % pn)
             self.queryLog.append("p_head: %s" % pn)
-            
-            if tn in pn:
-                logging.debug("query %s: matching hit was %d of %d" % (self.queryNo, eNo, len(entries)))
-                return e
-            else:
-                logging.debug("no substring found, going fuzzy")
-                #dist = self.fuzzy_substring(tn, pn)
-                dist = subdist.substring(unicode(tn), unicode(pn))
-                logging.debug("fuzzy: %d off" % dist)
-                if float(dist)/len(tn) < 0.1: # up to 10 percent off ok?
-                    logging.debug("fuzzy: accepting %f off" % ( float(dist)/len(tn) )) 
-                    return e
+            matcher = self.headMatcher = (p_head, TitleMatcher(pn))
+        return matcher[1]
+
+    def matchScholarEntries(self, p_head, entries):
+        """the entry whose title is least off the head of the pdf; entries
+        can be a generator, which is left as soon as a title matches exactly"""
+        matcher = self.titleMatcher(p_head)
+        seen = []
+        titles = []
+        def normalized():
+            for e in entries:
+                seen.append(e)
+                titles.append(self.normalizeTitle(e['title']))
+                yield titles[-1]
+        eNo, dist = matcher.best(normalized())
+        self.queryLog.append("retrieved %d of %s entries" % (len(seen), self.gs_hits))
+        if eNo is None:
+            logging.debug("result %s: no match in %d entries (of %s)" % (self.queryNo, len(seen), self.gs_hits))
+            self.queryLog.append("no match in %d entries (of %s)" % (len(seen), self.gs_hits))
+            return None
+        logging.debug("query %s: matching hit was %d of %d (%d off)" % (self.queryNo, eNo + 1, len(seen), dist))
+        self.queryLog.append("normalized title to match: %s (%d off)" % (titles[eNo], dist))
+        return seen[eNo]
     
     def getScholarQuery(self, p, windex=0):
         if self.doi:
@@ -271,29 +803,107 @@ class PdfMeatFile:
             return 1
 
     
-    def md5file(self, block_size=2**20):
-        fh = open(self.filename)
-        md5 = hashlib.md5()
-        while True:
-            data = fh.read(block_size)
-            if not data:
-                break
-            md5.update(data)
-        return md5.hexdigest()
+    def extractText(self, options=None, data=None):
+        """text of as few pages as setFragments needs (see PAGE_STEPS),
+        starting from the text cached for this file, if any"""
+        self.textOptions = options
+        self.pdfdata = data
+        self.rawtext, self.pages, self.complete = '', 0, False
+        key = self.cacheKey() if self.hashsum is not None else None
+        if CACHE is not None and key is not None:
+            cached = CACHE.getText(key)
+            if cached is not None:
+                self.rawtext, self.pages, self.complete = cached
+                logging.debug("%s: cached text of %d pages" % (self.filename, self.pages))
+        if self.pages == 0:
+            self.extendText()
+        while not self.fragmentsFound(self.rawtext) and self.extendText():
+            pass
+        self.pdftext = self.rawtext
+        return self.rawtext
+
+    def extendText(self):
+        """add the text of the next PAGE_STEPS pages; False if there are no more"""
+        if self.filename is None or self.complete:
+            return False
+        last = [step for step in PAGE_STEPS if step > self.pages]
+        if not last:
+            self.complete = True
+            return False
+        first, last = self.pages + 1, last[0]
+        t0 = time.time()
+        txt = self.pdfToText(self.textOptions, self.pdfdata, first, last) or ''
+        logging.debug("%s: pdftotext pages %d-%d %.3fs" % (self.filename, first, last, time.time() - t0))
+        self.rawtext += txt
+        self.pages = last
+        # pdftotext ends each page with a form feed: fewer means no more pages
+        self.complete = last == PAGE_STEPS[-1] or txt.count('\f') < last - first + 1
+        if CACHE is not None and self.hashsum is not None:
+            CACHE.putText(self.cacheKey(), self.rawtext, self.pages, self.complete)
+        return True
+
+    def fragmentsFound(self, p):
+        """the title head, and an abstract or a DOI; the head is looked for
+        in the first 999 characters only, so more pages can't change it"""
+        if len(p) < 999 and not FRAGMENTS['head'].search(p):
+            return False
+        return FRAGMENTS['abstract'].search(p) is not None or FRAGMENTS['doi'].search(p) is not None
+
+    def decodeText(self, p):
+        try:
+            p = unicode(p.decode('utf8').encode('translit/long'))
+            logging.debug('processfile encoding 1')
+            #logging.debug(p[:444])
+        except:
+            try:
+                #p = unidecode.unidecode(p)
+                p = (p.decode('utf8'))
+                logging.debug('processfile encoding 2')
+            except:
+                logging.debug('processfile encoding 3')
+                pass
+        return p
+
+    def readPdf(self):
+        fh = open(self.filename, 'rb')
+        try:
+            return fh.read()
+        finally:
+            fh.close()
+
+    def setHash(self, data):
+        self.hashname = HASH
+        self.hashsum = HASHES[HASH][1](data)
+        if HASH == 'md5':
+            self.md5sum = self.hashsum
+
+    def ingest(self, options=None):
+        """read the pdf once: hash its bytes and, unless the result is cached,
+        give the same bytes to pdftotext. True if the result was cached."""
+        t0 = time.time()
+        data = self.readPdf()
+        t1 = time.time()
+        self.setHash(data)
+        t2 = time.time()
+        cached = CACHE is not None and self.loadCached()
+        if not cached:
+            self.extractText(options, data)
+        t3 = time.time()
+        logging.info("%s: read %.3fs (%d bytes), %s %.3fs, pdftotext %.3fs%s" % (self.filename, t1 - t0, len(data), HASH, t2 - t1, t3 - t2, ' (cached)' if cached else ''))
+        return cached
 
-    
     def setFragments(self):
         if self.pdftext is None:
             return
         p = self.pdftext
         p_head = p[0:999] # title in first x chars?
-        m = re.search(r"(.*?)((abstract)|(introduction))\n", p_head, re.I|re.S)
+        m = FRAGMENTS['head'].search(p_head)
         if m is not None and m.group(1) is not None:
             p_head = m.group(1)
 
         self.pdfhead = p_head
         abstract = None
-        m = re.search(r'(?:(?i)Abstract)[:\. \n]+([A-Z].{99,3333})(\n[0-9 \.]*(?:(?i)Introduction))', p, re.S)
+        m = FRAGMENTS['abstract'].search(p)
         if m is not None:
             abstract = m.group(1).strip(' 12.') # strip space, 1. intro  -- as above regex with {99,3333} is greedy
             self.abstract = abstract
@@ -304,35 +914,33 @@ class PdfMeatFile:
 
         doi = None
         # DOI 10.1007/s00778-005-0158-4
-        m = re.search(r'DOI (\d\d\.\d\d\d\d/\w[^ \n]+)', p, re.I | re.S)
+        m = FRAGMENTS['doi'].search(p)
         if m is not None:
             doi = m.group(1)
             self.doi = doi
             
     def processFile(self):
         logging.info("processfile %s" % self.filename)
+
+        if self.filename is not None and self.pdftext is None and self.hashsum is None:
+            if self.ingest(['-enc','UTF-8']):
+                return self.bibtex
+        else:
+            if self.filename is not None and self.hashsum is None:
+                self.setHash(self.readPdf())
+            if CACHE is not None and self.loadCached():
+                return self.bibtex
         
         if self.pdftext is None and self.filename is not None:
             #p = self.pdfToText(self.filename, " -enc ASCII7") #self.pdftext
             logging.debug("processfile: pdftotext")            
-            p = self.pdfToText(['-enc','UTF-8'])
+            p = self.extractText(['-enc','UTF-8'])
             logging.debug("processfile: pdftotext.")            
         else:
             p = self.pdftext
             logging.debug("processfile: loading text.")            
 
-        try:
-            p = unicode(p.decode('utf8').encode('translit/long'))
-            logging.debug('processfile encoding 1')
-            #logging.debug(p[:444])
-        except:
-            try:
-                #p = unidecode.unidecode(p)
-                p = (p.decode('utf8'))
-                logging.debug('processfile encoding 2')
-            except:
-                logging.debug('processfile encoding 3')
-                pass
+        p = self.decodeText(p)
         self.pdftext = p
 
         if p is None and (self.doi is not None or self.title is not None):
@@ -341,68 +949,15 @@ class PdfMeatFile:
             if self.doi is not None:
                 p = self.doi
 
-        if self.filename is not None:
-            self.md5sum = self.md5file()
-            
         #p_utf = self.pdfToText(f, "-enc UTF-8")
       
         self.setFragments() # self.pdfhead, self.abstract
         logging.debug("processfile: setting fragments.")
         
-        gs_tryNo = 0 #110
-        ga_tryNo = 0 #110
-        querywordsoffset = 64
-        e = None
-        while (e is None and (gs_tryNo < GS_TRIES or ga_tryNo < GA_TRIES)):
-            if gs_tryNo < GS_TRIES:
-                q = self.getScholarQuery(p, gs_tryNo * querywordsoffset)
-                gs_tryNo += 1
-                if len(q) < 3:
-                    logging.debug("skipping too short query: %s" % q)
-                    self.queryLog.append("skipping too short query: %s" % q)
-                    continue
-            elif ga_tryNo < GA_TRIES:
-                ga_q = self.getScholarQuery(p, ga_tryNo * querywordsoffset)
-                ga_tryNo += 1
-                ga_query = urllib.urlencode({'q' : ga_q}) #.encode('utf8')
-                url = GA_URL % ( ga_query )
-                resultset = urllib2.urlopen(url).read()
-                if resultset is not None:
-                    resjs = anyjson.deserialize(resultset) #load()
-                    logging.debug(resultset)
-                    
-                    if resjs is not None:
-                        if type(resjs) is dict and len(resjs['responseData']['results'])>0:
-                            result = resjs['responseData']['results']
-                            q = urllib.unquote(result[0]['url'])
-                            logging.info("web search result: %s" % q)
-                            self.queryLog.append("web search result: %s" % q)
-                        else:
-                            logging.info("web search: no result")
-                            self.queryLog.append("web search: no result")
-                            continue
-            
-            query = urllib.urlencode({'q' : q}) #.encode('utf8')
-            gsu = GS_URL % (query)
-            gsc = self.getWebdata(gsu)
-            gs_hits = self.parse_scholar_hit_count(gsc)
-
-            logging.debug("result %d+%d hits: %s" % (gs_tryNo, ga_tryNo, str(gs_hits)))
-            self.queryLog.append("result %d+%d hits: %s" % (gs_tryNo, ga_tryNo, str(gs_hits)))
-            self.gs_hits = gs_hits
-            #TODO: if gs_hits > threshold: be more specific. else: be less specific -- aka adaptive querying
-
-            if self.gs_hits > 0:
-                entries = self.parseScholar(gsc)
-                self.queryLog.append("retrieved %d of %s entries" % (len(entries), self.gs_hits))
-
-                if self.filename is None:
-                    e = entries[0]
-                else:
-                    e = self.matchScholarEntries(self.pdfhead, entries)
-                    if e is None:
-                        logging.debug("result %s: no match in %d entries (of %s)" % (self.queryNo, len(entries), self.gs_hits))
-                        self.queryLog.append("no match in %d entries (of %s)" % (len(entries), self.gs_hits))
+        if SPECULATE > 0:
+            e = self.speculate(self.candidateQueries(p), SPECULATE)
+        else:
+            e = self.queryInTurn(p)
         
         if e is None:
             logging.info("%s: tried %d+%d queries, no (matching) result. giving up" % (self.filename, GS_TRIES, GA_TRIES) )
@@ -419,105 +974,217 @@ class PdfMeatFile:
                     _b = self.getWebdata(importlink)
                     _b = _b.replace(r'{\\"', r'{\"')
                     self.bibtex = _b
-                    if self.filename is not None:
-                        self._append_bibtex('file={file://' + os.path.realpath(self.newfilename) + ':pdf}')
-                        self._append_bibtex('md5sum={' + self.md5sum + '}')
-                    try:
-                        self._append_bibtex('url={' + e['url'] + '}')
-                    except (KeyError, TypeError): # e['url'] can be None?
-                        pass # cannot be
-                    try:        
-                        self._append_bibtex('htmllink={' + e['htmllink'] + '}')
-                    except (KeyError, TypeError):
-                        pass
-                    try:
-                        self._append_bibtex('citations={' + e['citations'] + '}')
-                        self._append_bibtex('citedbyid={' + e['citedbyid'] + '}')                
-                    except (KeyError, TypeError):
-                        pass
-                    try:
-                        self._append_bibtex('doi={' + self.doi + '}')
-                    except (KeyError, TypeError):
-                        pass
-        
-                    if self.abstract is not None:
-                        self._append_bibtex("abstract={" + self.abstract + "}")
-                    
-                    if self.mailhosts is not None:
-                        self._append_bibtex("mailhosts={" + "; ".join(self.mailhosts) + "}")
-                    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    
-                    if self.filename is not None:
-                        self._append_bibtex("pdfmeat={timestamp: %s; queries: %d; inode: %d}" % (timestamp, self.queryNo, os.stat(self.newfilename).st_ino))
-                    else:
-                        self._append_bibtex("pdfmeat={timestamp: %s; queries: %d}" % (timestamp, self.queryNo))
+                    if CACHE is not None:
+                        self.storeCached(e)
+                    self.augmentBibtex(e)
 
             except (KeyError):
                 logging.warning("cannot retrieve bibtex")
         return self.bibtex
         
-    def _append_bibtex(self, keyvalue):
-        keyvalue = r",\n  " + keyvalue  
-        self.bibtex = re.sub(r"}\n", r"}" + keyvalue + r"\n", self.bibtex, 1)
-        return self.bibtex
+    def queryInTurn(self, p):
+        """try the queries one after another, until one finds a match"""
+        gs_tryNo = 0 #110
+        ga_tryNo = 0 #110
+        e = None
+        while (e is None and (gs_tryNo < GS_TRIES or ga_tryNo < GA_TRIES)):
+            if gs_tryNo < GS_TRIES:
+                q = self.getScholarQuery(p, gs_tryNo * QUERYWORDSOFFSET)
+                if len(q) < 3 and self.extendText():
+                    # not enough words yet for this query: more pages
+                    p = self.pdftext = self.decodeText(self.rawtext)
+                    continue
+                gs_tryNo += 1
+                if len(q) < 3:
+                    logging.debug("skipping too short query: %s" % q)
+                    self.queryLog.append("skipping too short query: %s" % q)
+                    continue
+            elif ga_tryNo < GA_TRIES:
+                ga_q = self.getScholarQuery(p, ga_tryNo * QUERYWORDSOFFSET)
+                ga_tryNo += 1
+                q = self.webSearch(ga_q)
+                if q is None:
+                    continue
+            e = self.tryQuery(q, "%d+%d" % (gs_tryNo, ga_tryNo))
+        return e
+
+    def candidateQueries(self, p):
+        """all the queries queryInTurn would try, as (label, kind, query):
+        kind 'gs' goes to scholar as it is, 'ga' to a web search first"""
+        tasks = []
+        gs_tryNo = 0
+        while gs_tryNo < GS_TRIES:
+            q = self.getScholarQuery(p, gs_tryNo * QUERYWORDSOFFSET)
+            if len(q) < 3 and self.extendText():
+                p = self.pdftext = self.decodeText(self.rawtext)
+                continue
+            gs_tryNo += 1
+            if len(q) < 3:
+                logging.debug("skipping too short query: %s" % q)
+                self.queryLog.append("skipping too short query: %s" % q)
+                continue
+            if q not in [t[2] for t in tasks if t[1] == 'gs']: # with a doi or title, all are the same
+                tasks.append(("%d+0" % gs_tryNo, 'gs', q))
+        for ga_tryNo in range(GA_TRIES):
+            q = self.getScholarQuery(p, ga_tryNo * QUERYWORDSOFFSET)
+            if q not in [t[2] for t in tasks if t[1] == 'ga']:
+                tasks.append(("%d+%d" % (GS_TRIES, ga_tryNo + 1), 'ga', q))
+        return tasks
+
+    def speculate(self, tasks, workers):
+        """send the queries of tasks (see candidateQueries) workers at a time;
+        the first match wins and the queries not sent yet are dropped.
+        Queries already sent are left to finish, their results unused.
+        With FAILTOBROWSER, the browser is opened once, on the first query
+        without scholar results, and only if none of the queries matched."""
+        todo = Queue.Queue()
+        for i, task in enumerate(tasks):
+            todo.put((i,) + task)
+        results = Queue.Queue()
+        done = threading.Event()
+
+        def work():
+            while True:
+                try:
+                    i, label, kind, q = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                e = None
+                empty = []
+                try:
+                    if not done.is_set() and kind == 'ga':
+                        q = self.webSearch(q, done)
+                    if not done.is_set() and q is not None:
+                        e = self.tryQuery(q, label, done, empty)
+                except QueryCancelled:
+                    pass
+                except Exception, err: # as a failed query in queryInTurn would, but only this one
+                    logging.exception("%s: query %s failed: %s" % (self.filename, label, err))
+                results.put((i, e, empty))
+
+        for _ in range(min(workers, len(tasks))):
+            t = threading.Thread(target=work)
+            t.daemon = True
+            t.start()
+        e = None
+        answered = 0
+        empty = []
+        while e is None and answered < len(tasks):
+            i, e, urls = results.get()
+            empty.extend((i, url) for url in urls)
+            answered += 1
+        done.set()
+        if e is not None:
+            logging.debug("speculative: match in answer %d of %d queries" % (answered, len(tasks)))
+        elif FAILTOBROWSER is True and empty:
+            import webbrowser
+            webbrowser.get().open_new_tab(min(empty)[1])
+        return e
+
+    def webSearch(self, ga_q, cancel=None):
+        """url of the first web search result for ga_q, to query scholar with"""
+        ga_query = urllib.urlencode({'q' : ga_q}) #.encode('utf8')
+        url = GA_URL % ( ga_query )
+        resultset = web().fetch(url, cancel=cancel)
+        if resultset is None:
+            return None
+        resjs = anyjson.deserialize(resultset) #load()
+        logging.debug(resultset)
+        if type(resjs) is dict and len(resjs['responseData']['results'])>0:
+            result = resjs['responseData']['results']
+            q = urllib.unquote(result[0]['url'])
+            logging.info("web search result: %s" % q)
+            self.queryLog.append("web search result: %s" % q)
+            return q
+        logging.info("web search: no result")
+        self.queryLog.append("web search: no result")
+        return None
+
+    def tryQuery(self, q, label, cancel=None, empty=None):
+        """the entry of the scholar results for q which matches the pdf, or None;
+        given a list empty, the url is added to it if scholar has no results,
+        instead of being opened in the browser"""
+        query = urllib.urlencode({'q' : q}) #.encode('utf8')
+        gsu = GS_URL % (query)
+        gsc = self.getWebdata(gsu, cancel, empty is None)
+        if empty is not None and re.search(REGS['none'], gsc):
+            empty.append(gsu)
+        gs_hits = self.parse_scholar_hit_count(gsc)
+
+        logging.debug("result %s hits: %s" % (label, str(gs_hits)))
+        self.queryLog.append("result %s hits: %s" % (label, str(gs_hits)))
+        self.gs_hits = gs_hits
+        #TODO: if gs_hits > threshold: be more specific. else: be less specific -- aka adaptive querying
+
+        if gs_hits > 0:
+            entries = self.parseScholar(gsc)
+            if self.filename is None:
+                return next(entries, None)
+            return self.matchScholarEntries(self.pdfhead, entries)
+        return None
+
+    def augmentBibtex(self, e):
+        """add the pdfmeat fields (file, md5sum, url, ...) to the fetched bibtex"""
+        entry = BibtexEntry(self.bibtex)
+        if entry.fields is None:
+            logging.warning("%s: cannot parse the bibtex, appending the fields to it" % self.filename)
+        if self.filename is not None:
+            entry['file'] = 'file://' + os.path.realpath(self.newfilename) + ':pdf'
+            entry[HASHES[self.hashname][0]] = self.hashsum
+        for field in ('url', 'htmllink', 'citations', 'citedbyid'):
+            if e.get(field) is not None: # e['url'] can be None?
+                entry[field] = e[field]
+        if self.doi is not None:
+            entry['doi'] = self.doi
+
+        if self.abstract is not None:
+            entry['abstract'] = self.abstract
+
+        if self.mailhosts is not None:
+            entry['mailhosts'] = "; ".join(self.mailhosts)
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        if self.filename is not None:
+            entry['pdfmeat'] = "timestamp: %s; queries: %d; inode: %d" % (timestamp, self.queryNo, os.stat(self.newfilename).st_ino)
+        else:
+            entry['pdfmeat'] = "timestamp: %s; queries: %d" % (timestamp, self.queryNo)
+        self.bibtex = entry.serialize()
+
+    def cacheKey(self):
+        if self.hashsum is not None:
+            return self.hashname + ':' + self.hashsum
+        if self.doi is not None:
+            return 'doi:' + self.doi.strip().lower()
+        if self.title is not None:
+            return 'title:' + self.normalizeTitle(self.title)
+        return None
+
+    def loadCached(self):
+        """take fragments, entry and bibtex from the cache; True if there were any"""
+        key = self.cacheKey()
+        hit = CACHE.get(key) if key is not None else None
+        if hit is None:
+            return False
+        logging.info("%s: cached result for %s" % (self.filename, key))
+        self.pdfhead = hit.get('pdfhead')
+        self.abstract = hit.get('abstract')
+        if self.doi is None:
+            self.doi = hit.get('doi')
+        self.gs_entry = hit['entry']
+        self.bibtex = hit['bibtex']
+        self.augmentBibtex(self.gs_entry)
+        return True
+
+    def storeCached(self, e):
+        """remember fragments, entry and bibtex (before augmentBibtex)"""
+        key = self.cacheKey()
+        if key is None:
+            return
+        CACHE.put(key, {'pdfhead': self.pdfhead, 'abstract': self.abstract, 'doi': self.doi, 'entry': e, 'bibtex': self.bibtex})
 
     def parseScholar(self, content):
-      pa = re.compile('(<h3 class="gs_rt">(.*?)</div></div>)', re.DOTALL)
-      myItems = []
-      for m in re.finditer(pa, content):
-        a = m.group(1)
-        a = re.sub('</?b>', '', a)
-        a = re.sub('<font .*?>\[[^\]]+\]</font>', '', a)
-        a = re.sub('&nbsp;|<br>', '', a)
-        a = re.sub('&hellip;', '...', a)
-        a = re.sub('&amp;', '&', a) # 2010-02-22
-        pt = re.compile('<h3.*?>.*?(?:<span .*?</span> )?((<a href="([^"]+)"[^>]*>)?([^<]+)(</a>)?)</h3>')
-        myItem = {}
-        m1 = re.search(pt, a)
-        if m1 != None:    
-          myItem['url'] = m1.group(3)
-          myItem['title'] = m1.group(4) #.strip()
-
-          pc = re.compile('>Cited by ([0-9]+)<')
-          m2 = re.search(pc, a)
-          if m2 != None:
-            myItem['citations'] = m2.group(1)
-          pcl = re.compile(' href="/scholar\?([^"]*cites=([0-9]+))')
-          m_pcl = re.search(pcl, a)
-          if m_pcl != None:
-            myItem['citedbyid'] = m_pcl.group(2)
-          authorvenueyear = ''
-          pa = re.compile('<div class="gs_a">(.*?)</div>')
-          m3 = re.search(pa, a)
-          if m3 != None:
-            authorvenueyear = m3.group(1)
-            pavy = re.compile('^(.*?)( - ((?:(.*?), ((?:19|20)[0-9][0-9])|(((?:19|20)[0-9][0-9])|(.*?)))))? - (.*)$')
-            m4 = re.search(pavy, authorvenueyear)
-            if m4 != None:
-              myItem['authors'] = re.sub('<[^<]+?>', '', m4.group(1))
-              if m4.group(4) != None:
-                myItem['venue'] = m4.group(4)
-              if m4.group(5) != None and re.match('(19|20)[0-9][0-9]', m4.group(5)):
-                myItem['year'] = m4.group(5)
-              if m4.group(6) != None and re.match('(19|20)[0-9][0-9]', m4.group(6)):
-                myItem['year'] = m4.group(6)            
-              if m4.group(7) != None and re.match('(19|20)[0-9][0-9]', m4.group(7)):
-                myItem['year'] = m4.group(7)
-              if m4.group(8) != None:
-                myItem['venue'] = m4.group(8)
-              if m4.group(9) != None:
-                myItem['publisher'] = m4.group(9)
-          pca = re.compile('q=cache:([^+"]+)[^"]*">View as HTML</a>')
-          m_pca = re.search(pca, a)
-          if m_pca != None:
-            myItem['htmllink'] = 'http://scholar.google.com/scholar?q=cache:' + m_pca.group(1)
-          pim = re.compile('href="/scholar\.([^"]+)".*?>Import into .*?</a>')
-          m_pim = re.search(pim, a)
-          if m_pim != None:
-            myItem['importlink'] = 'http://scholar.google.com/scholar.' + m_pim.group(1)
-          # querylink = "http://scholar.google.com/scholar?q=" + urllib.quote("intitle:\"" + title + "\"")
-          myItems.append(myItem)    
-      return myItems
+        """the entries of a scholar result page, as a generator (see scholar_entries)"""
+        return scholar_entries(content)
 
     def _rename_file(self, filename, name_new = None):
         target_dir = os.path.dirname(os.path.realpath(filename))
@@ -544,7 +1211,92 @@ class PdfMeatFile:
             bibkey = m_bibkey.group(1)
         return bibkey
 
+def init_extractor(cache_path):
+    global CACHE
+    CACHE = ResultCache(cache_path) if cache_path is not None else None
+
+def extract(filename):
+    """hash and pdftotext of one file, from one read; runs in the batch
+    process pool. pdftotext is skipped for files already in the cache."""
+    pf = PdfMeatFile(filename=filename)
+    try:
+        t0 = time.time()
+        data = pf.readPdf()
+        pf.setHash(data)
+        if CACHE is not None and CACHE.get(pf.cacheKey()) is not None:
+            return filename, None, pf.hashsum
+        t1 = time.time()
+        text = pf.extractText(['-enc','UTF-8'], data)
+        logging.info("%s: read and %s %.3fs (%d bytes), pdftotext %.3fs (%d pages)" % (filename, HASH, t1 - t0, len(data), time.time() - t1, pf.pages))
+        return filename, (text, pf.pages, pf.complete), pf.hashsum
+    except (OSError, IOError), err:
+        logging.error("%s: extraction failed: %s" % (filename, err))
+        return filename, None, None
+
+def lookup(extracted):
+    """query and match one extracted file; runs in the batch thread pool"""
+    filename, text, hashsum = extracted
+    if hashsum is None:
+        return filename, None
+    pf = PdfMeatFile(filename=filename)
+    if text is not None:
+        pf.rawtext, pf.pages, pf.complete = text
+        pf.pdftext = pf.rawtext
+        pf.textOptions = ['-enc','UTF-8']
+    pf.hashname = HASH
+    pf.hashsum = hashsum
+    if HASH == 'md5':
+        pf.md5sum = hashsum
+    try:
+        pf.processFile()
+    except Exception, err: # one bad file or response should not end the batch
+        logging.exception("%s: lookup failed: %s" % (filename, err))
+    return filename, pf.bibtex
+
+def batch_files(directory=None, pattern=None, stdin=False):
+    files = []
+    if directory is not None:
+        files.extend(sorted(glob.glob(os.path.join(directory, pattern or '*.pdf'))))
+    elif pattern is not None:
+        files.extend(sorted(glob.glob(pattern)))
+    if stdin:
+        files.extend(line.strip() for line in sys.stdin if line.strip())
+    return [f for f in files if os.path.isfile(f)]
+
+def batch(files, out, jobs=None, lookups=2, interval=1.0, cache_path=None):
+    """Extract text and hashes in a process pool, look up in a few threads,
+    and write each BibTeX entry to out as soon as it is found."""
+    global CACHE
+    web().limiter.interval = interval
+    extractors = multiprocessing.Pool(jobs or multiprocessing.cpu_count(), init_extractor, (cache_path,))
+    # opened after the pool is forked, the workers open their own
+    if cache_path is not None:
+        CACHE = ResultCache(cache_path)
+    searchers = ThreadPool(lookups)
+    found = 0
+    try:
+        extracted = extractors.imap_unordered(extract, files)
+        for filename, bibtex in searchers.imap_unordered(lookup, extracted):
+            if bibtex is None:
+                logging.info("%s: no entry" % filename)
+                sys.stderr.write("pdfmeat: no entry for %s\n" % filename)
+                continue
+            found += 1
+            if isinstance(bibtex, unicode):
+                bibtex = bibtex.encode('utf8')
+            out.write(bibtex.rstrip('\n') + '\n\n')
+            out.flush()
+    finally:
+        extractors.close()
+        searchers.close()
+        extractors.join()
+        searchers.join()
+    logging.info("batch: %d of %d files found" % (found, len(files)))
+    logging.info("batch: %s" % web().stats())
+    return found
+
 def main():
+    global CACHE, HASH, SESSION, SPECULATE
     
     parser = argparse.ArgumentParser(description='PDF Metadata acquisition tool.', argument_default=argparse.SUPPRESS)
     parser.add_argument('--PDF', default=None, help='pdf file in question')
@@ -552,17 +1304,50 @@ def main():
     parser.add_argument('--inject',  action='store_true', default=False, help='inject metadata into PDF (requires according Perl script)')
     parser.add_argument('--title', default=None, help="Title of document")
     parser.add_argument('--doi', default=None, help="DOI of document")
+    parser.add_argument('--cache', default=CACHE_PATH, help='where to keep found entries, by md5 of the pdf (default: %(default)s)')
+    parser.add_argument('--hash', choices=sorted(HASHES), default=HASH, help='file hash for the cache and the bibtex: md5 (md5sum field, default) or crc32 (faster)')
+    parser.add_argument('--no-cache', dest='nocache', action='store_true', default=False, help='neither use nor update the cache')
+    parser.add_argument('--dir', default=None, help='batch: process the pdf files in this directory')
+    parser.add_argument('--glob', default=None, help='batch: files to process, e.g. "papers/*.pdf" (with --dir: pattern within it)')
+    parser.add_argument('--stdin', action='store_true', default=False, help='batch: read file names to process from stdin, one per line')
+    parser.add_argument('--output', default=None, help='batch: write the BibTeX entries to this file instead of stdout')
+    parser.add_argument('--jobs', type=int, default=None, help='batch: processes for pdftotext and hashing (default: number of cpus)')
+    parser.add_argument('--lookups', type=int, default=2, help='batch: lookups in flight at once (default: 2)')
+    parser.add_argument('--speculate', type=int, default=SPECULATE, metavar='N', help='send all the queries for a pdf at once, N at a time, and take the first match (default: one after another)')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between requests to the same host (default: 1)')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT, help='seconds to wait for a connection or an answer (default: %(default)s)')
+    parser.add_argument('--retries', type=int, default=RETRIES, help='times to try again after a captcha, waiting twice as long each time (default: %(default)s)')
+    parser.add_argument('--backoff', type=float, default=BACKOFF, help='seconds to wait after the first captcha (default: %(default)s)')
     filename, title, doi = None,None,None
 
     args = parser.parse_args()
+    HASH = args.hash
+    SPECULATE = max(args.speculate, 0)
+    SESSION = WebSession(args.interval, args.timeout, args.retries, args.backoff)
+    cache_path = None if args.nocache else os.path.expanduser(args.cache)
+    if args.dir or args.glob or args.stdin:
+        files = batch_files(args.dir, args.glob, args.stdin)
+        if args.output is not None:
+            out = open(args.output, 'w')
+        else:
+            out = sys.stdout
+        try:
+            batch(files, out, args.jobs, max(args.lookups, 1), args.interval, cache_path)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        parser.exit()
     if args.PDF:
         filename = args.PDF
         if not os.path.isfile(filename):
             parser.error('file not found: ' + filename)
             parser.exit()
 
+    if cache_path is not None:
+        CACHE = ResultCache(cache_path)
     pf = PdfMeatFile(filename=filename, title=args.title, doi=args.doi)
     pf.processFile()
+    logging.info(SESSION.stats())
     
     if pf.bibtex is not None and args.inject is True:
         proc = subprocess.Popen('./bibtex2pdfmeta.pl -', shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE )
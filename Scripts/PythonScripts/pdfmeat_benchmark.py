@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""Benchmark the parts of pdfmeat.py which run on every query.
+
+    python pdfmeat_benchmark.py --cases 200 --pages saved/ --output bench.json
+
+matchScholarEntries is timed against the implementation it replaced, which
+went through the entries in turn with subdist.substring, on made-up pdf
+heads and result lists. parseScholar is timed against the parser it
+replaced, on the scholar result pages saved in --pages (*.html), or else on
+made-up ones. The results are JSON: the best time of each, and how often
+the two agreed.
+"""
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import random
+import re
+import sys
+import time
+
+import subdist
+
+import pdfmeat
+
+words = [
+    'analysis', 'bayesian', 'constraint', 'database', 'efficient', 'entity',
+    'evaluation', 'framework', 'graphs', 'incremental', 'integration',
+    'learning', 'matching', 'metadata', 'model', 'networks', 'ontology',
+    'queries', 'reasoning', 'retrieval', 'schema', 'semantic', 'similarity',
+    'string', 'systems', 'towards', 'uncertain', 'web', 'xml'
+]
+
+names = ['Aumueller', 'Doe', 'Garcia', 'Müller', 'Nguyen', 'Rahm', 'Smith']
+
+places = [
+    'University of Leipzig', 'Institut für Informatik', 'Dept. of Computer Science',
+    'Germany', 'USA', '{aumueller,rahm}@informatik.uni-leipzig.de'
+]
+
+
+def made_up_title(rng):
+    return ' '.join(rng.choice(words) for _ in range(rng.randint(4, 10))).capitalize()
+
+
+def misspelt(rng, title, edits):
+    """title with edits random characters changed, as pdftotext might"""
+    title = list(title)
+    for _ in range(edits):
+        i = rng.randrange(len(title))
+        title[i] = rng.choice('abcdefghijklmnopqrstuvwxyz ')
+    return ''.join(title)
+
+
+def made_up_case(rng, entries=10):
+    """(pdf head, scholar entries): the title of the pdf is among the
+    entries four times in five, sometimes with a few characters off"""
+    title = made_up_title(rng)
+    head = '\n'.join([
+        misspelt(rng, title, rng.choice([0, 0, 1, 2])),
+        ', '.join(rng.sample(names, 3)),
+    ] + rng.sample(places, 3))
+    found = [{'title': made_up_title(rng)} for _ in range(entries)]
+    if rng.random() < 0.8:
+        found[rng.randrange(entries)] = {'title': title}
+    return head, found
+
+
+def match_in_turn(pf, p_head, entries):
+    """matchScholarEntries as it was: the first entry within 10 percent"""
+    pn = pf.normalizeTitle(p_head)
+    for e in entries:
+        tn = pf.normalizeTitle(e['title'])
+        if tn in pn:
+            return e
+        dist = subdist.substring(unicode(tn), unicode(pn))
+        if float(dist)/len(tn) < 0.1:
+            return e
+
+
+def parse_scholar_as_was(content):
+    """parseScholar as it was, compiling its patterns for every hit"""
+    pa = re.compile('(<h3 class="gs_rt">(.*?)</div></div>)', re.DOTALL)
+    myItems = []
+    for m in re.finditer(pa, content):
+        a = m.group(1)
+        a = re.sub('</?b>', '', a)
+        a = re.sub('<font .*?>\[[^\]]+\]</font>', '', a)
+        a = re.sub('&nbsp;|<br>', '', a)
+        a = re.sub('&hellip;', '...', a)
+        a = re.sub('&amp;', '&', a)
+        pt = re.compile('<h3.*?>.*?(?:<span .*?</span> )?((<a href="([^"]+)"[^>]*>)?([^<]+)(</a>)?)</h3>')
+        myItem = {}
+        m1 = re.search(pt, a)
+        if m1 != None:
+            myItem['url'] = m1.group(3)
+            myItem['title'] = m1.group(4)
+            pc = re.compile('>Cited by ([0-9]+)<')
+            m2 = re.search(pc, a)
+            if m2 != None:
+                myItem['citations'] = m2.group(1)
+            pcl = re.compile(' href="/scholar\?([^"]*cites=([0-9]+))')
+            m_pcl = re.search(pcl, a)
+            if m_pcl != None:
+                myItem['citedbyid'] = m_pcl.group(2)
+            pa = re.compile('<div class="gs_a">(.*?)</div>')
+            m3 = re.search(pa, a)
+            if m3 != None:
+                authorvenueyear = m3.group(1)
+                pavy = re.compile('^(.*?)( - ((?:(.*?), ((?:19|20)[0-9][0-9])|(((?:19|20)[0-9][0-9])|(.*?)))))? - (.*)$')
+                m4 = re.search(pavy, authorvenueyear)
+                if m4 != None:
+                    myItem['authors'] = re.sub('<[^<]+?>', '', m4.group(1))
+                    if m4.group(4) != None:
+                        myItem['venue'] = m4.group(4)
+                    if m4.group(5) != None and re.match('(19|20)[0-9][0-9]', m4.group(5)):
+                        myItem['year'] = m4.group(5)
+                    if m4.group(6) != None and re.match('(19|20)[0-9][0-9]', m4.group(6)):
+                        myItem['year'] = m4.group(6)
+                    if m4.group(7) != None and re.match('(19|20)[0-9][0-9]', m4.group(7)):
+                        myItem['year'] = m4.group(7)
+                    if m4.group(8) != None:
+                        myItem['venue'] = m4.group(8)
+                    if m4.group(9) != None:
+                        myItem['publisher'] = m4.group(9)
+            pca = re.compile('q=cache:([^+"]+)[^"]*">View as HTML</a>')
+            m_pca = re.search(pca, a)
+            if m_pca != None:
+                myItem['htmllink'] = 'http://scholar.google.com/scholar?q=cache:' + m_pca.group(1)
+            pim = re.compile('href="/scholar\.([^"]+)".*?>Import into .*?</a>')
+            m_pim = re.search(pim, a)
+            if m_pim != None:
+                myItem['importlink'] = 'http://scholar.google.com/scholar.' + m_pim.group(1)
+            myItems.append(myItem)
+    return myItems
+
+
+def made_up_page(rng, hits=10):
+    """a scholar result page in the layout parseScholar expects"""
+    page = ['<html><body><div id="gs_ab_md">About %d results</div>' % rng.randint(hits, 9999)]
+    for i in range(hits):
+        title = made_up_title(rng).replace('web', '<b>web</b>').replace(' and ', ' &amp; ')
+        pdf = '<span class="gs_ctc"><font size=-2>[PDF]</font></span> ' if rng.random() < 0.3 else ''
+        venue = rng.choice([
+            'Journal of Data Semantics, %d' % rng.randint(1990, 2012),
+            '%d' % rng.randint(1990, 2012),
+            'Proc. VLDB&hellip;'
+        ])
+        cites = rng.randint(0, 500)
+        page.append(
+            '<div class="gs_r"><h3 class="gs_rt">%s<a href="http://example.org/%d.pdf">%s</a></h3>'
+            '<div class="gs_a">%s - %s - example.org</div>'
+            '<div class="gs_rs">%s&nbsp;&hellip;<br></div>'
+            '<div class="gs_fl"><a href="/scholar?cites=%d&amp;hl=en">Cited by %d</a> '
+            '<a href="/scholar?q=cache:k%d:scholar.google.com/+x&amp;hl=en">View as HTML</a> '
+            '<a href="/scholar.bib?q=info:k%d:scholar.google.com/&amp;output=citation">Import into BibTeX</a></div></div>'
+            % (pdf, i, title, ', '.join(rng.sample(names, 2)), venue, made_up_title(rng), rng.randint(1, 10**9), cites, i, i)
+        )
+    page.append('</body></html>')
+    return '\n'.join(page)
+
+
+def timed(function, repeat):
+    """Call function repeat times, and return the best time and the last result."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.time()
+        result = function()
+        best = min(best, time.time() - start)
+    return best, result
+
+
+def bench_matching(cases, repeat):
+    pf = pdfmeat.PdfMeatFile()
+    rng = random.Random(0)
+    made_up = [made_up_case(rng) for _ in range(cases)]
+
+    def old():
+        return [match_in_turn(pf, head, entries) for head, entries in made_up]
+
+    def new():
+        found = []
+        for head, entries in made_up:
+            # a new file for each pdf, as the head is only normalized once per file
+            pf = pdfmeat.PdfMeatFile()
+            found.append(pf.matchScholarEntries(head, entries))
+        return found
+    old_seconds, old_found = timed(old, repeat)
+    new_seconds, new_found = timed(new, repeat)
+    return {
+        'cases': cases,
+        'entries_per_case': 10,
+        'subdist_seconds': old_seconds,
+        'bounded_seconds': new_seconds,
+        'speedup': old_seconds / new_seconds if new_seconds else None,
+        'matched': sum(1 for e in new_found if e is not None),
+        'same_entry': sum(1 for a, b in zip(old_found, new_found) if a is b)
+    }
+
+
+def bench_parsing(pages, repeat):
+    """pages: the contents of scholar result pages"""
+    def old():
+        return [parse_scholar_as_was(page) for page in pages]
+
+    def new():
+        return [list(pdfmeat.scholar_entries(page)) for page in pages]
+
+    def first():
+        # what the generator saves when the first entry matches
+        return [next(pdfmeat.scholar_entries(page), None) for page in pages]
+    old_seconds, old_entries = timed(old, repeat)
+    new_seconds, new_entries = timed(new, repeat)
+    first_seconds, _ = timed(first, repeat)
+    return {
+        'pages': len(pages),
+        'entries': sum(len(entries) for entries in new_entries),
+        'as_was_seconds': old_seconds,
+        'compiled_seconds': new_seconds,
+        'first_entry_seconds': first_seconds,
+        'speedup': old_seconds / new_seconds if new_seconds else None,
+        'same_pages': sum(1 for a, b in zip(old_entries, new_entries) if a == b)
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cases', type=int, default=200, help='Number of made-up pdfs to match')
+    parser.add_argument('--pages', metavar='DIR', help='Saved scholar result pages (*.html) to parse; made-up ones if not given')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timings to take the best of')
+    parser.add_argument('--output', help='Write the results to a file instead of stdout')
+    args = parser.parse_args()
+    if args.pages:
+        pages = []
+        for path in sorted(glob.glob(os.path.join(args.pages, '*.html'))):
+            with open(path) as f:
+                pages.append(f.read().decode('utf8'))
+    else:
+        rng = random.Random(0)
+        pages = [made_up_page(rng) for _ in range(args.cases)]
+    results = {
+        'date': datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'matching': bench_matching(args.cases, args.repeat),
+        'parsing': bench_parsing(pages, args.repeat)
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
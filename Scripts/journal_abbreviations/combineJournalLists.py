@@ -1,33 +1,132 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 
 # Python script for combining several journal abbreviation lists
 # and producing an alphabetically sorted list. If the same journal
 # names are repeated, only the version found last is retained.
 #
 # Usage: combineJournalLists.py outfile infile1 infile2 ...
+#
+# Lists which are already sorted are merged as they are read, so memory
+# use doesn't grow with their size. Lists which aren't are first sorted
+# in chunks of --chunk-lines lines, which are kept in temporary files.
 
-import sys
-import fnmatch
+import argparse
+import heapq
+import itertools
 import os
+import tempfile
+
+# Lines written out at a time
+write_batch = 10000
+
+# What Python 2's str.strip took off; some names end in a no-break space
+whitespace = " \t\n\r\x0b\x0c"
+
+
+def key(line):
+    return line.partition("=")[0].strip(whitespace)
+
+
+def journal_lines(path, counts):
+    # Yield the journal lines of a list, stripped, in the order they come
+    # counts[path] is the number of them, once they have all been read
+    counts[path] = 0
+    # Only "\n" ends a line, as it did in Python 2
+    with open(path, "r", encoding="utf-8", newline="\n") as f:
+        for line in f:
+            if "=" in line and line[0] != "#":
+                counts[path] += 1
+                yield line.strip(whitespace)
+
+
+def is_sorted(path):
+    previous = None
+    for line in journal_lines(path, {}):
+        current = key(line)
+        if previous is not None and current < previous:
+            return False
+        previous = current
+    return True
+
+
+def sorted_runs(path, counts, chunk_lines, directory):
+    # Sort a list a chunk at a time, writing each chunk to a file
+    # Return the files, each of which is sorted
+    runs = []
+    lines = journal_lines(path, counts)
+    while True:
+        chunk = list(itertools.islice(lines, chunk_lines))
+        if not chunk:
+            break
+        # sorted is stable, so repeats stay in the order they came in
+        chunk.sort(key=key)
+        run = tempfile.TemporaryFile(
+            "w+", encoding="utf-8", newline="\n", dir=directory
+        )
+        run.writelines(line + "\n" for line in chunk)
+        run.seek(0)
+        runs.append(run)
+    return runs
+
+
+def keyed(lines, rank):
+    # Pair lines with what to merge them by
+    # rank puts the later of two lines with the same journal after the other
+    for position, line in enumerate(lines):
+        yield (key(line), rank, position), line
+
+
+def combine(out_file, in_files, chunk_lines=100000):
+    counts = {}
+    temporary = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(out_file)))
+    streams = []
+    opened = []
+    try:
+        for i, path in enumerate(in_files):
+            if is_sorted(path):
+                streams.append(keyed(journal_lines(path, counts), (i, 0)))
+                continue
+            runs = sorted_runs(path, counts, chunk_lines, temporary)
+            opened.extend(runs)
+            for j, run in enumerate(runs):
+                lines = (line.rstrip("\n") for line in run)
+                streams.append(keyed(lines, (i, j)))
+        combined = 0
+        with open(out_file, "w", encoding="utf-8", buffering=1 << 20) as f:
+            batch = []
+            merged = heapq.merge(*streams)
+            # Only the last of the lines for a journal is kept
+            groups = itertools.groupby(merged, lambda item: item[0][0])
+            for _, group in groups:
+                for _, line in group:
+                    pass
+                batch.append(line + "\n")
+                combined += 1
+                if len(batch) >= write_batch:
+                    f.writelines(batch)
+                    batch = []
+            f.writelines(batch)
+    finally:
+        for run in opened:
+            run.close()
+        os.rmdir(temporary)
+    return counts, combined
+
 
-outFile = sys.argv[1]
-dictionary = dict()
-
-for i in range(2,len(sys.argv)):
-    count = 0
-    f = open(sys.argv[i], "r")
-    for line in f:
-        if "=" in line:
-                if line[0] != "#":
-                    count = count+1
-                    parts = line.partition("=")
-                    dictionary[parts[0].strip()] = line.strip()
-    f.close()
-    print sys.argv[i]+": "+str(count)
-
-print "Combined key count: "+str(len(dictionary))
-
-f = open(outFile, "w")
-for key in sorted(dictionary.iterkeys()):
-    f.write(dictionary[key]+"\n")
-f.close()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Combine journal abbreviation lists into one sorted list."
+    )
+    parser.add_argument("outfile")
+    parser.add_argument("infiles", nargs="+")
+    parser.add_argument(
+        "--chunk-lines",
+        type=int,
+        default=100000,
+        help="Lines of an unsorted list to sort in memory at once"
+    )
+    args = parser.parse_args()
+    counts, combined = combine(args.outfile, args.infiles, args.chunk_lines)
+    for path in args.infiles:
+        print(path + ": " + str(counts[path]))
+    print("Combined key count: " + str(combined))